@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Size and extraction-speed benchmarks for the runtime archive codec.
+#
+# Packs a directory (by default the cpython runtime `feetmaker.py build`
+# staged for an arch) with each codec and level, the same way the build
+# does, then times full extraction of every archive to disk. Extraction is
+# what each user pays for on first run, so it is reported next to archive
+# size to pick the trade-off per release.
+#
+#     python benchmarks/bench_codecs.py
+#     python benchmarks/bench_codecs.py -c deflate:1 -c deflate:9 -c lzma -o codecs.json
+#
+# lzma is measured for comparison only; the bootloader cannot extract it.
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+import feetmaker  # noqa: E402
+
+
+codecs = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+default_codecs = ['stored', 'deflate:1', 'deflate:6', 'deflate:9', 'bzip2:9', 'lzma']
+
+parser = argparse.ArgumentParser(description='Benchmark runtime archive codecs')
+parser.add_argument('source', nargs='?', default=None,
+                    help='directory to archive (default: build/staging/ARCH/cpython)')
+parser.add_argument('-a', '--arch', default='win32', choices=['win32', 'amd64'],
+                    help='arch whose staged runtime to archive when no source is given')
+parser.add_argument('-c', '--codec', action='append',
+                    help='codec[:level] to measure, may be repeated (default: %s)' % ', '.join(default_codecs))
+parser.add_argument('-n', '--repeat', type=int, default=5)
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1)
+parser.add_argument('-o', '--output', default='bench_codecs.json')
+
+
+def parse_codec(spec):
+    name, _, level = spec.partition(':')
+    if name not in codecs:
+        raise SystemExit(f"unknown codec {name!r}, choose from {', '.join(codecs)}")
+    return name, codecs[name], int(level) if level else 9
+
+
+def extract(archive, dest):
+    start = time.perf_counter()
+    with zipfile.ZipFile(archive) as zipf:
+        zipf.extractall(dest)
+    return time.perf_counter() - start
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'median': statistics.median(ordered),
+        'p95': ordered[max(0, math.ceil(0.95 * len(ordered)) - 1)],
+        'min': ordered[0],
+        'samples': samples,
+    }
+
+
+def main(args):
+    source = os.path.abspath(args.source or os.path.join(repo, 'build', 'staging', args.arch, 'cpython'))
+    if not os.path.isdir(source):
+        raise SystemExit(f"{source} does not exist, run `feetmaker.py build -a {args.arch}` first")
+    members = feetmaker.collect_files(source, os.path.dirname(source), feetmaker.zip_excludes)
+    uncompressed = sum(os.stat(src).st_size for src, name in members)
+    print(f"{len(members)} files, {uncompressed / 1e6:.1f}MB uncompressed from {source}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for spec in args.codec or default_codecs:
+            name, compression, level = parse_codec(spec)
+            archive = os.path.join(workdir, 'runtime.zip')
+
+            start = time.perf_counter()
+            feetmaker.write_zip(archive, members, compression, args.jobs, level)
+            build_time = time.perf_counter() - start
+
+            samples = []
+            for i in range(args.repeat):
+                dest = os.path.join(workdir, f'extract{i}')
+                samples.append(extract(archive, dest))
+                shutil.rmtree(dest)
+
+            result = summarize(samples)
+            result['size'] = os.stat(archive).st_size
+            result['ratio'] = result['size'] / uncompressed if uncompressed else 1.0
+            result['build'] = build_time
+            results[spec] = result
+            os.remove(archive)
+            print(f"{spec:12} {result['size'] / 1e6:8.2f}MB ({result['ratio']:6.1%})  "
+                  f"extract median {result['median'] * 1000:8.1f}ms  p95 {result['p95'] * 1000:8.1f}ms  "
+                  f"build {build_time:6.2f}s")
+
+    output = {
+        'meta': {
+            'feet_version': feetmaker.version.strip(),
+            'source': source,
+            'files': len(members),
+            'uncompressed': uncompressed,
+            'repeat': args.repeat,
+            'platform': platform.platform(),
+            'time': time.time(),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print("Results written to", args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Launch latency benchmarks for the Feet run path.
+#
+# Drives feet/feet.py directly, the way the bootloader does, inside a scratch
+# app directory with a stand-in interpreter in place of the extracted
+# cpython/python.exe. Every scenario is repeated and reported as median and
+# p95 wall time, and the results are written as JSON so they can be compared
+# against an earlier run with --compare.
+#
+#     python benchmarks/bench_launch.py -o before.json
+#     python benchmarks/bench_launch.py -o after.json --compare before.json
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+feet_py = os.path.join(repo, 'feet', 'feet.py')
+
+scenarios = {
+    'run': ['run'],
+    'setup': ['setup'],
+    'library-update': ['library', '--update'],
+}
+
+parser = argparse.ArgumentParser(description='Benchmark Feet launch latency')
+parser.add_argument('--python', default=sys.executable,
+                    help='stand-in interpreter for the runtime python.exe')
+parser.add_argument('--data-dir', default=None,
+                    help='use an existing extracted <name>_data directory instead of a scratch one')
+parser.add_argument('--main', default=None, help='main.py to launch (default: an empty script)')
+parser.add_argument('--requirements', default=None, help='requirements.txt to place beside main.py')
+parser.add_argument('-n', '--repeat', type=int, default=10)
+parser.add_argument('-s', '--scenario', action='append', choices=sorted(scenarios))
+parser.add_argument('-o', '--output', default='bench_launch.json')
+parser.add_argument('--compare', default=None, help='earlier results to check for regressions')
+parser.add_argument('--threshold', type=float, default=0.10,
+                    help='relative median slowdown reported as a regression')
+
+
+def make_app(workdir, args):
+    app = os.path.join(workdir, 'app')
+    os.makedirs(app)
+    if args.main:
+        shutil.copy(args.main, os.path.join(app, 'main.py'))
+    else:
+        open(os.path.join(app, 'main.py'), 'w').close()
+    if args.requirements:
+        shutil.copy(args.requirements, os.path.join(app, 'requirements.txt'))
+
+    data = os.path.join(app, 'feet_data')
+    if args.data_dir:
+        shutil.copytree(args.data_dir, data, symlinks=True)
+    else:
+        os.makedirs(os.path.join(data, 'cpython'))
+        shutil.copy(feet_py, data)
+        os.symlink(os.path.abspath(args.python), os.path.join(data, 'cpython', 'python.exe'))
+    # feet.py expects the runner executable beside the data directory
+    open(os.path.join(app, 'feet.exe'), 'a').close()
+    return app, data
+
+
+def launch(app, data, command):
+    cmd = [os.path.join(data, 'cpython', 'python.exe'), os.path.join(data, 'feet.py'), *command]
+    start = time.perf_counter()
+    p = subprocess.run(cmd, cwd=app, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    if p.returncode:
+        raise SystemExit(f"{' '.join(command)} failed:\n{p.stderr.decode(errors='replace')}")
+    return elapsed
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'median': statistics.median(ordered),
+        'p95': ordered[max(0, math.ceil(0.95 * len(ordered)) - 1)],
+        'min': ordered[0],
+        'samples': samples,
+    }
+
+
+def bench(args, command):
+    results = {}
+
+    # Cold: a freshly created data dir for every launch, with nothing cached
+    # from earlier runs
+    samples = []
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as workdir:
+            app, data = make_app(workdir, args)
+            samples.append(launch(app, data, command))
+    results['cold'] = summarize(samples)
+
+    # Warm: the same data dir launched over and over after one warmup run
+    with tempfile.TemporaryDirectory() as workdir:
+        app, data = make_app(workdir, args)
+        launch(app, data, command)
+        results['warm'] = summarize([launch(app, data, command) for _ in range(args.repeat)])
+
+    return results
+
+
+def compare(old, new, threshold):
+    regressions = []
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if before:
+            change = result['median'] / before['median'] - 1
+            print(f"{name:24} {before['median'] * 1000:8.1f}ms -> {result['median'] * 1000:8.1f}ms ({change:+.1%})")
+            if change > threshold:
+                regressions.append(name)
+    return regressions
+
+
+def main(args):
+    results = {}
+    for name in args.scenario or sorted(scenarios):
+        for mode, result in bench(args, scenarios[name]).items():
+            key = f'{name}/{mode}'
+            results[key] = result
+            print(f"{key:24} median {result['median'] * 1000:8.1f}ms  p95 {result['p95'] * 1000:8.1f}ms")
+
+    with open(os.path.join(repo, 'VERSION.txt')) as f:
+        version = f.read().strip()
+    output = {
+        'meta': {
+            'feet_version': version,
+            'python': args.python,
+            'data_dir': args.data_dir,
+            'repeat': args.repeat,
+            'platform': platform.platform(),
+            'time': time.time(),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print("Results written to", args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(old, output, args.threshold)
+        if regressions:
+            print("Regressions:", ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parser.parse_args()))
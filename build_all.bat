@@ -1,4 +1,2 @@
-python feetmaker.py python -a amd64
-python feetmaker.py build -a amd64
-python feetmaker.py python -a win32
-python feetmaker.py build -a win32
\ No newline at end of file
+python feetmaker.py python -a amd64 -a win32
+python feetmaker.py build -a amd64 -a win32
\ No newline at end of file
@@ -2,8 +2,8 @@ use std::env;
 use std::ffi::OsString;
 use std::fs;
 use std::io;
-use std::io::{Error, Write, stdout};
-use std::path::Path;
+use std::io::{Error, Read, Seek, SeekFrom, Write, stdout};
+use std::path::{Path, PathBuf};
 use std::process::{Command, Stdio};
 
 
@@ -15,7 +15,117 @@ fn get_exec_stem() -> OsString {
 }
 
 
-fn extract_runtime(exec_name: OsString, data_dir: OsString) -> Result<(), Error> {
+// The JSON metadata comment feetmaker writes at the very end of the exe
+fn read_metadata(exec_name: &OsString) -> Result<String, Error> {
+    let mut file = fs::File::open(exec_name)?;
+    let len = file.metadata()?.len();
+    file.seek(SeekFrom::Start(if len > 4096 { len - 4096 } else { 0 }))?;
+    let mut tail = Vec::new();
+    file.read_to_end(&mut tail)?;
+    Ok(String::from_utf8_lossy(&tail).into_owned())
+}
+
+
+fn metadata_value(metadata: &str, key: &str) -> Option<String> {
+    let pattern = format!("\"{}\": \"", key);
+    let start = metadata.rfind(&pattern)? + pattern.len();
+    let end = metadata[start..].find('"')? + start;
+    Some(metadata[start..end].to_string())
+}
+
+
+fn default_store() -> Option<PathBuf> {
+    let base = if cfg!(windows) {
+        env::var_os("LOCALAPPDATA").map(PathBuf::from)
+    } else {
+        env::var_os("XDG_CACHE_HOME").map(PathBuf::from)
+            .or_else(|| env::var_os("HOME").map(|home| PathBuf::from(home).join(".cache")))
+    };
+    Some(base?.join("feet").join("runtimes"))
+}
+
+
+// Where this exe's runtime lives in the shared store, if it uses one: under
+// FEET_RUNTIME_STORE when that is set, otherwise in the user cache dir for
+// exes built with --shared-runtime
+fn shared_runtime_dir(metadata: &str) -> Option<PathBuf> {
+    let id = metadata_value(metadata, "feet_runtime_id")?;
+    let store = match env::var_os("FEET_RUNTIME_STORE") {
+        Some(dir) if !dir.is_empty() => PathBuf::from(dir),
+        _ => {
+            if metadata_value(metadata, "feet_runtime_store").as_deref() != Some("shared") {
+                return None;
+            }
+            default_store()?
+        },
+    };
+    Some(store.join(id))
+}
+
+
+// The cpython directory of an extracted app, in the shared store if
+// runtime.txt points there
+fn runtime_dir(data_dir: &str) -> PathBuf {
+    match fs::read_to_string(Path::new(data_dir).join("runtime.txt")) {
+        Ok(dir) => PathBuf::from(dir.trim()),
+        Err(_) => Path::new(data_dir).join("cpython"),
+    }
+}
+
+
+fn extract_file(file: &mut zip::read::ZipFile, outpath: &Path) -> Result<(), Error> {
+    if (&*file.name()).ends_with('/') {
+        fs::create_dir_all(outpath)?;
+    } else {
+        if let Some(p) = outpath.parent() {
+            if !p.exists() {
+                fs::create_dir_all(&p)?;
+            }
+        }
+        let mut outfile = fs::File::create(outpath)?;
+        io::copy(file, &mut outfile)?;
+    }
+
+    #[cfg(unix)]
+    {
+        use std::os::unix::fs::PermissionsExt;
+
+        if let Some(mode) = file.unix_mode() {
+            fs::set_permissions(outpath, fs::Permissions::from_mode(mode))?;
+        }
+    }
+    Ok(())
+}
+
+
+// Extract the runtime's cpython directory into the shared store, once for
+// every app built with the same runtime
+fn extract_shared_runtime(exec_name: &OsString, dir: &Path) -> Result<(), Error> {
+    if dir.exists() {
+        return Ok(());
+    }
+    println!("Extracting the shared Python Feet Runtime... (one-time operation)");
+
+    let tmp = dir.with_extension(format!("tmp{}", std::process::id()));
+    let file = fs::File::open(exec_name)?;
+    let mut archive = zip::ZipArchive::new(file).unwrap();
+    for i in 0..archive.len() {
+        let mut file = archive.by_index(i).unwrap();
+        let outpath = match file.sanitized_name().strip_prefix("feet/cpython") {
+            Ok(rest) => tmp.join(rest),
+            Err(_) => continue,
+        };
+        extract_file(&mut file, &outpath)?;
+    }
+    if fs::rename(&tmp, dir).is_err() {
+        // Another app extracted the same runtime first
+        let _ = fs::remove_dir_all(&tmp);
+    }
+    Ok(())
+}
+
+
+fn extract_runtime(exec_name: OsString, data_dir: OsString, shared: Option<&Path>) -> Result<(), Error> {
     println!("Extracting the Python Feet Runtime... (one-time operation)");
 
     let file = fs::File::open(&exec_name).unwrap();
@@ -26,33 +136,28 @@ fn extract_runtime(exec_name: OsString, data_dir: OsString) -> Result<(), Error>
         let mut file = archive.by_index(i).unwrap();
         let outpath = file.sanitized_name();
 
-        if (&*file.name()).ends_with('/') {
-            fs::create_dir_all(&outpath).unwrap();
-        } else {
+        // Apps packed with `feet exe --zipimport` are imported from the
+        // exe itself and never extracted, and a shared runtime is already
+        // in the store
+        if (&*file.name()).starts_with("pyz/") {
+            continue;
+        }
+        if shared.is_some() && (&*file.name()).starts_with("feet/cpython/") {
+            continue;
+        }
+
+        if !(&*file.name()).ends_with('/') {
             if i % 100 == 0 && i != 0 {
                 println!(" {}% ", ((i as f64 / total as f64) * 100.0) as i32);
             } else if i != 0 {
                 print!(".");
                 stdout().flush()?;
             }
-            if let Some(p) = outpath.parent() {
-                if !p.exists() {
-                    fs::create_dir_all(&p).unwrap();
-                }
-            }
-            let mut outfile = fs::File::create(&outpath).unwrap();
-            io::copy(&mut file, &mut outfile).unwrap();
-        }
-
-        // Get and Set permissions
-        #[cfg(unix)]
-        {
-            use std::os::unix::fs::PermissionsExt;
-
-            if let Some(mode) = file.unix_mode() {
-                fs::set_permissions(&outpath, fs::Permissions::from_mode(mode)).unwrap();
-            }
         }
+        extract_file(&mut file, &outpath)?;
+    }
+    if let Some(dir) = shared {
+        fs::write("feet/runtime.txt", dir.to_string_lossy().as_bytes())?;
     }
     std::fs::rename("feet", &data_dir)?;
     println!(" done!");
@@ -60,6 +165,21 @@ fn extract_runtime(exec_name: OsString, data_dir: OsString) -> Result<(), Error>
 }
 
 
+// Bring an extracted runtime up to date with this executable in place, by
+// having feet.py rewrite only the files that differ from the manifest
+fn sync_runtime(data_dir: &str) -> Result<bool, Error> {
+    println!("Updating the Python Feet Runtime...");
+    let script = format!("{}/feet.py", data_dir);
+    let status = Command::new(runtime_dir(data_dir).join("python"))
+        .args(&[script.as_str(), "sync"])
+        .stderr(Stdio::inherit())
+        .stdout(Stdio::inherit())
+        .stdin(Stdio::inherit())
+        .status()?;
+    Ok(status.success())
+}
+
+
 fn main() -> Result<(), Error> {
     let exec = std::env::current_exe()?;
     let exec_path = Path::new(&exec);
@@ -93,21 +213,35 @@ fn main() -> Result<(), Error> {
         std::process::exit(1);
     }
 
-    // If a pre-existing extracted runtime directory exists, clear it if
-    // it is older than this executable
+    // Apps sharing a runtime make sure the store has it before anything else
+    let shared = shared_runtime_dir(&read_metadata(&exec_name.to_os_string())?);
+    if let Some(dir) = &shared {
+        extract_shared_runtime(&exec_name.to_os_string(), dir)?;
+    }
+
+    // If a pre-existing extracted runtime directory exists, update it if
+    // it is older than this executable. Runtimes extracted with a manifest
+    // are synced file by file, anything else is cleared and extracted again.
     if Path::new(&data_dir).exists() {
         let mod_exec = Path::new(&exec_name).metadata()?.modified()?;
         let mod_runtime = Path::new(&data_dir).metadata()?.modified()?;
 
         if mod_exec > mod_runtime {
-            fs::remove_dir_all(Path::new(&data_dir))?;
+            if let Some(dir) = &shared {
+                fs::write(Path::new(&data_dir).join("runtime.txt"), dir.to_string_lossy().as_bytes())?;
+            }
+            let synced = Path::new(&data_dir).join("manifest.json").exists()
+                && sync_runtime(&data_dir).unwrap_or(false);
+            if !synced {
+                fs::remove_dir_all(Path::new(&data_dir))?;
+            }
         }
     }
 
     // If there is no runtime directory, either because this is a first-run
     // or the directory was cleared for a new version, extract the whole thing
     if !Path::new(&data_dir).exists() {
-        match extract_runtime(exec_name.to_owned(), OsString::from(data_dir.to_owned())) {
+        match extract_runtime(exec_name.to_owned(), OsString::from(data_dir.to_owned()), shared.as_deref()) {
             Ok(()) => (),
             Err(err) => panic!(err)
         }
@@ -117,7 +251,7 @@ fn main() -> Result<(), Error> {
     if Path::new("./requirements.txt").exists() && !Path::new(&data_dir).join("requirements_installed.txt").exists() {
         let script = &format!("{}/feet.py", data_dir);
         println!("Installing requirements... {}", script);
-        let mut child = Command::new(format!("{}/cpython/python", data_dir))
+        let mut child = Command::new(runtime_dir(&data_dir).join("python"))
             .args(&[script, "library", "--update"])
             .stderr(Stdio::inherit())
             .stdout(Stdio::inherit())
@@ -130,7 +264,7 @@ fn main() -> Result<(), Error> {
     // Now, runtime is either extracted or already was, so run the commands
 
     // println!("{}/feet.py", data_dir);
-    let mut child = Command::new(format!("{}/cpython/python", data_dir))
+    let mut child = Command::new(runtime_dir(&data_dir).join("python"))
         .arg(format!("{}/feet.py", data_dir))
         .args(args)
         .stderr(Stdio::inherit())
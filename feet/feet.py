@@ -1,23 +1,32 @@
-import argparse
-import fnmatch
-import glob
-import itertools
+# Only what the run path needs is imported here. Everything else is imported
+# by the commands that use it, to keep app launches fast.
 import os
-import pkg_resources
-import shutil
 import subprocess
 import sys
-import zipfile
 
 root = os.path.abspath(os.path.dirname(__file__))
 
 def _set_root_relative():
     global feet_bin
+    global runtime_dir
+    global shared_runtime
     global site_packages
+    global requirements_state
     global zip_excludes
 
     feet_bin = root.split('_data')[0] + '.exe'
-    site_packages = os.path.join(root, 'cpython', 'lib', 'site-packages')
+    # Apps using a shared runtime store get its location from runtime.txt,
+    # and keep their libraries to themselves
+    try:
+        with open(os.path.join(root, 'runtime.txt')) as f:
+            runtime_dir = f.read().strip()
+        shared_runtime = True
+        site_packages = os.path.join(root, 'site-packages')
+    except OSError:
+        runtime_dir = os.path.join(root, 'cpython')
+        shared_runtime = False
+        site_packages = os.path.join(runtime_dir, 'lib', 'site-packages')
+    requirements_state = os.path.join(root, 'requirements_state.txt')
 
     zip_excludes = [
         "*.pyc",
@@ -62,79 +71,1251 @@ ERROR: You're seeing this help text because FEET cannot find your main.py
 file. Put this EXE in a folder with your main.py script and run it again!
 """
 
-parser = argparse.ArgumentParser(description='Make Python Run')
-subparsers = parser.add_subparsers(dest='command')
+def make_parser():
+    import argparse
 
-run_parser = subparsers.add_parser('run')
+    parser = argparse.ArgumentParser(description='Make Python Run')
+    subparsers = parser.add_subparsers(dest='command')
 
-library_parser = subparsers.add_parser('library')
-library_parser.add_argument('--update', action='store_true')
-library_parser.add_argument('spec', type=str, nargs='?')
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--in-process', dest='in_process', action='store_true',
+                            default=os.getenv('FEET_IN_PROCESS') == '1')
+    run_parser.add_argument('--profile-imports', dest='profile_imports', action='store_true')
+    run_parser.add_argument('--profile', dest='profile', action='store', nargs='?',
+                            const='feet.pstats', default=None, metavar='FILE')
+    run_parser.add_argument('--watch', dest='watch', action='store_true')
+    run_parser.add_argument('--preload', dest='preload', action='append', default=[], metavar='MODULE')
 
-shell_parser = subparsers.add_parser('shell')
+    library_parser = subparsers.add_parser('library')
+    library_parser.add_argument('--update', action='store_true')
+    library_parser.add_argument('-r', '--requirement', dest='requirements', action='append', default=[])
+    library_parser.add_argument('spec', type=str, nargs='*')
 
-setup_parser = subparsers.add_parser('setup')
+    shell_parser = subparsers.add_parser('shell')
 
-exe_parser = subparsers.add_parser('exe')
-exe_parser.add_argument('name', type=str, action='store')
-exe_parser.add_argument('files', type=str, nargs='*')
-exe_parser.add_argument('--confirm', action='store_true')
+    setup_parser = subparsers.add_parser('setup')
 
-zip_parser = subparsers.add_parser('zip')
-zip_parser.add_argument('name', type=str, action='store')
-zip_parser.add_argument('files', type=str, nargs='*')
+    exe_parser = subparsers.add_parser('exe')
+    exe_parser.add_argument('name', type=str, action='store')
+    exe_parser.add_argument('files', type=str, nargs='*')
+    exe_parser.add_argument('--confirm', action='store_true')
+    exe_parser.add_argument('--wheels', action='store_true')
+    exe_parser.add_argument('--zipimport', action='store_true')
+    exe_parser.add_argument('--compile', nargs='?', const='alongside', default=None,
+                            choices=('alongside', 'replace'))
 
+    zip_parser = subparsers.add_parser('zip')
+    zip_parser.add_argument('name', type=str, action='store')
+    zip_parser.add_argument('files', type=str, nargs='*')
+    zip_parser.add_argument('--wheels', action='store_true')
+    zip_parser.add_argument('--compile', nargs='?', const='alongside', default=None,
+                            choices=('alongside', 'replace'))
 
-def add_to_zip(path, dest, compression, prefix=None):
-    zipf = zipfile.ZipFile(dest, 'a', compression)
+    patch_parser = subparsers.add_parser('patch')
+    patch_parser.add_argument('old', type=str)
+    patch_parser.add_argument('new', type=str)
+    patch_parser.add_argument('-o', dest='output', type=str, default=None)
 
-    for root, _, files in os.walk(path):
+    apply_parser = subparsers.add_parser('apply')
+    apply_parser.add_argument('patch', type=str)
+    apply_parser.add_argument('target', type=str, nargs='?', default=None)
+    apply_parser.add_argument('-o', dest='output', type=str, default=None)
+
+    verify_parser = subparsers.add_parser('verify')
+
+    sync_parser = subparsers.add_parser('sync')
+
+    return parser
+
+
+def _normcase(name):
+    return os.path.normcase(name).replace('\\', '/')
+
+
+def _gitignore_rule(line):
+    import re
+
+    line = line.rstrip('\r\n')
+    if not line.strip() or line.startswith('#'):
+        return None
+    line = line.rstrip(' ')
+    if os.name == 'nt':
+        line = line.lower()
+
+    negate = line.startswith('!')
+    if negate or line.startswith(('\\#', '\\!')):
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    anchored = '/' in line
+    line = line.lstrip('/')
+
+    regex = '' if anchored else '(?:.*/)?'
+    i = 0
+    while i < len(line):
+        if line.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif line.startswith('/**', i) and i + 3 == len(line):
+            regex += '/.*'
+            i += 3
+        elif line[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif line[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif line[i] == '[' and ']' in line[i + 2:]:
+            end = line.index(']', i + 2)
+            chars = line[i + 1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '[' + chars + ']'
+            i = end + 1
+        elif line[i] == '\\' and i + 1 < len(line):
+            regex += re.escape(line[i + 1])
+            i += 2
+        else:
+            regex += re.escape(line[i])
+            i += 1
+
+    # A pattern that matches a directory also matches everything inside it
+    return re.compile(regex + r'(/.*)?\Z', re.S), negate, dir_only
+
+
+# Patterns use fnmatch semantics, like zip_excludes. The optional ignore file
+# uses gitignore semantics and is applied after them, so it can re-include
+# names with `!pattern`. The matcher is called with a project relative path
+# and whether that path is a directory.
+def compile_excludes(patterns=(), ignore_file='.feetignore'):
+    import fnmatch
+    import re
+
+    rules = []
+    if patterns:
+        regex = '|'.join(fnmatch.translate(_normcase(p)) for p in patterns)
+        rules.append((re.compile(regex), False, False))
+    if ignore_file and os.path.exists(ignore_file):
+        with open(ignore_file) as f:
+            rules.extend(rule for rule in map(_gitignore_rule, f) if rule)
+
+    def excluded(name, is_dir=False):
+        name = _normcase(name)
+        for regex, negate, dir_only in reversed(rules):
+            match = regex.match(name)
+            if match and (is_dir or not dir_only or match.group(1)):
+                return not negate
+        return False
+
+    return excluded
+
+
+def walk_files(path, excluded):
+    for root, dirs, files in os.walk(path):
+        # Prune excluded directories before the walk descends into them
+        dirs[:] = [
+            d for d in dirs
+            if not excluded(os.path.relpath(os.path.join(root, d), "."), True)
+        ]
         for file in files:
             src = os.path.join(root, file)
             name = os.path.relpath(src, ".")
-            base = name.split(os.path.sep, 1)[0]
-
-            # print(name, '...', end='')
-            excluded = False
-            for pattern in zip_excludes:
-                if fnmatch.fnmatch(name, pattern):
-                    excluded = True
-                    # print('skip')
-                    break
-            if not excluded:
-                # print('ok')
-                if prefix:
-                    name = os.path.relpath(os.path.join(prefix, name))
-                name = name.replace('\\', '/')
-                try:
-                    zipf.getinfo(name)
-                except KeyError:
-                    zipf.write(src, name)
-    
-    zipf.close()
+            if not excluded(name):
+                yield src, name
 
 
 def get_app_files(files, exclude=()):
+    import itertools
+
     if files:
         yield from files
     else:
+        excluded = compile_excludes(list(itertools.chain(zip_excludes, exclude)))
         for fn in os.listdir('.'):
-            include = True
-            for exc in itertools.chain(zip_excludes, exclude):
-                if fnmatch.fnmatch(fn, exc):
-                    include = False
-                    break
-            if include:
+            if not excluded(fn, os.path.isdir(fn)):
                 yield fn
 
 
+def collect_members(files, exclude=(), prefix=None, extra=()):
+    import itertools
+
+    # Build the full member list in one pass: generated extras and explicit
+    # files first, then everything else in the project, each archive name
+    # only once. Directories aren't members, the walk adds their files.
+    sources = itertools.chain(
+        extra,
+        ((f, f) for f in get_app_files(files, exclude)),
+        walk_files(".", compile_excludes(zip_excludes)),
+    )
+    seen = set()
+    members = []
+    for src, name in sources:
+        if os.path.isdir(src):
+            continue
+        if prefix:
+            name = os.path.join(prefix, name)
+        name = os.path.normpath(name).replace('\\', '/').lstrip('/')
+        if name not in seen:
+            seen.add(name)
+            members.append((src, name))
+    return members
+
+
+def hash_file(path):
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digests(path):
+    import hashlib
+    import zlib
+
+    # CRC-32 to compare with a previous bundle and sha256 for the manifest,
+    # in a single read
+    crc = 0
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(chunk, crc)
+            digest.update(chunk)
+    return crc, digest.hexdigest()
+
+
+def open_previous(dest):
+    import zipfile
+
+    if not os.path.exists(dest):
+        return None
+    try:
+        return zipfile.ZipFile(dest)
+    except (OSError, zipfile.BadZipFile):
+        return None
+
+
+def copy_bytes(src, dest, length):
+    while length:
+        chunk = src.read(min(length, 1 << 20))
+        if not chunk:
+            raise EOFError(f"{getattr(src, 'name', 'input')} ended {length} bytes early")
+        dest.write(chunk)
+        length -= len(chunk)
+
+
+def copy_file(src, dest):
+    import shutil
+
+    # Copy in the kernel, without reading the file through Python: shutil
+    # uses sendfile or fcopyfile where the platform has them, and Windows'
+    # CopyFileW can clone blocks instead of copying them
+    if sys.platform == 'win32':
+        import ctypes
+        if ctypes.windll.kernel32.CopyFileW(src, dest, False):
+            return
+    shutil.copyfile(src, dest)
+
+
+def copy_member(zf, previous, info):
+    import struct
+    import zipfile
+
+    # Append a member from the previous bundle still compressed, laid out
+    # exactly as ZipFile.write() would have written it. zipfile has no public
+    # API for this, so this is the only writer here that touches ZipFile
+    # internals (fp, _writecheck, _didModify and start_dir); checked against
+    # CPython 3.8, 3.11, 3.12 and 3.13.
+    previous.fp.seek(info.header_offset)
+    header = previous.fp.read(zipfile.sizeFileHeader)
+    name_size, extra_size = struct.unpack('<HH', header[26:30])
+    previous.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_size + extra_size)
+
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    for attr in ('compress_type', 'flag_bits', 'CRC', 'compress_size', 'file_size',
+                 'external_attr', 'create_system'):
+        setattr(zinfo, attr, getattr(info, attr))
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    zf.fp.seek(zf.start_dir)
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zf.fp.write(zinfo.FileHeader(zip64))
+    copy_bytes(previous.fp, zf.fp, info.compress_size)
+    zf.start_dir = zf.fp.tell()
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def member_info(name, st_mode=0, compression=0):
+    import zipfile
+
+    # A fixed timestamp and normalized permissions, so the same app files
+    # always produce a byte-identical bundle
+    zinfo = zipfile.ZipInfo(name, (1980, 1, 1, 0, 0, 0))
+    zinfo.create_system = 3
+    zinfo.external_attr = (0o100755 if st_mode & 0o111 else 0o100644) << 16
+    zinfo.compress_type = compression
+    return zinfo
+
+
+def write_member(zf, src, zinfo):
+    import shutil
+
+    with open(src, 'rb') as f, zf.open(zinfo, 'w') as dest:
+        shutil.copyfileobj(f, dest, 1 << 20)
+
+
+def write_bundle(dest, members, compression, base=None, manifest=None):
+    import json
+    import shutil
+    import zipfile
+
+    # The bundle is written to a fresh temporary file and only renamed into
+    # place once complete, so reruns never append to a stale archive.
+    # Members unchanged since the previous bundle at dest, by size, mode
+    # and CRC, are copied from it without being compressed again.
+    tmp = dest + '.tmp'
+    previous = open_previous(dest)
+    try:
+        if base:
+            copy_file(base, tmp)
+            shutil.copymode(base, tmp)
+        else:
+            open(tmp, 'wb').close()
+        with zipfile.ZipFile(tmp, 'a', compression) as zf:
+            files = {}
+            reused = 0
+            for src, name in sorted(members, key=lambda m: m[1]):
+                st = os.stat(src)
+                zinfo = member_info(name, st.st_mode, compression)
+                zinfo.file_size = st.st_size
+                crc, digest = file_digests(src)
+                old = previous and previous.NameToInfo.get(name)
+                if (old and not old.flag_bits & 0x08
+                        and (old.file_size, old.date_time, old.external_attr, old.CRC, old.compress_type)
+                        == (zinfo.file_size, zinfo.date_time, zinfo.external_attr, crc, compression)):
+                    copy_member(zf, previous, old)
+                    reused += 1
+                else:
+                    write_member(zf, src, zinfo)
+                files[name] = [zinfo.file_size, digest]
+            if previous:
+                print(f"Reused {reused} of {len(files)} files from the previous {os.path.basename(dest)}")
+            if manifest:
+                # Listed in the metadata comment so `feet sync` can find it
+                zf.writestr(member_info(manifest, compression=compression),
+                            json.dumps({'files': files}, indent=1, sort_keys=True))
+                try:
+                    meta = json.loads(zf.comment)
+                except ValueError:
+                    meta = {}
+                meta['feet_app_manifest'] = manifest
+                zf.comment = json.dumps(meta).encode('utf8')
+        if previous:
+            previous.close()
+            previous = None
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    finally:
+        if previous:
+            previous.close()
+
+
+def compile_source(job):
+    import py_compile
+
+    src, cfile, dfile = job
+    try:
+        py_compile.compile(
+            src, cfile, dfile, doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+        )
+    except py_compile.PyCompileError as e:
+        print("Not compiling", dfile, "-", str(e).strip().splitlines()[-1])
+        return False
+    return True
+
+
+def compile_members(workdir, members, mode, legacy=False, keep=()):
+    import importlib.util
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Compile every .py member in parallel worker processes of this runtime,
+    # so the bytecode matches the interpreter that will load it. Unchecked
+    # hash pycs are never validated against their source, so they still
+    # load after extraction gives the files new timestamps. zipimport only
+    # finds legacy name.pyc files beside the source, where the filesystem
+    # importer looks in __pycache__; with mode 'replace' the source is left
+    # out and name.pyc is imported on its own. Members named in keep, which
+    # are run as scripts and never imported, stay as they are.
+    jobs = []
+    cnames = []
+    for src, name in members:
+        if not name.endswith('.py') or name in keep:
+            continue
+        if legacy or mode == 'replace':
+            cname = name + 'c'
+        else:
+            cname = importlib.util.cache_from_source(name).replace('\\', '/')
+        jobs.append((src, os.path.join(workdir, 'pyc', *cname.split('/')), name))
+        cnames.append(cname)
+    if not jobs:
+        return members
+
+    with ProcessPoolExecutor() as pool:
+        compiled = list(pool.map(compile_source, jobs, chunksize=max(1, len(jobs) // 64)))
+    pycs = {
+        name: (cfile, cname)
+        for (src, cfile, name), cname, ok in zip(jobs, cnames, compiled)
+        if ok
+    }
+    print(f"Compiled {len(pycs)} of {len(jobs)} modules")
+
+    result = []
+    for src, name in members:
+        if name not in pycs or mode != 'replace':
+            result.append((src, name))
+        if name in pycs:
+            result.append(pycs[name])
+    return result
+
+
+def is_package_data(name):
+    # Files inside a package that code may read from disk. Typing markers
+    # and stubs are never opened at runtime, and install metadata is read
+    # through importlib.metadata, which handles archives.
+    top, _, rest = name.partition('/')
+    return bool(rest) and not (
+        top.endswith(('.dist-info', '.egg-info', '.data'))
+        or name.endswith(('.py', '.pyc', '.pyi'))
+        or os.path.basename(name) == 'py.typed'
+    )
+
+
+def pyz_members(workdir, files, exclude=(), compile=None):
+    import json
+
+    # App code goes under pyz/app/ and the installed libraries under pyz/lib/,
+    # where `run` imports them straight out of the exe. The app's other files
+    # keep their names, so the bootloader extracts them beside the exe where
+    # the app opens them. Packages with native extensions can't be imported
+    # from an archive, and packages shipping data files may open them beside
+    # their __file__, so the members of both are listed in
+    # feet/zipimport.json to be extracted when first imported.
+    members = [
+        (src, 'pyz/app/' + name if name.endswith('.py') else name)
+        for src, name in collect_members(files, exclude=exclude, prefix='.')
+    ]
+    excluded = compile_excludes(['*.pyc', '*__pycache__*'], ignore_file=None)
+    libs = []
+    native = set()
+    for dirpath, dirs, filenames in os.walk(site_packages):
+        dirs[:] = [d for d in dirs if not excluded(d, True)]
+        for fn in filenames:
+            src = os.path.join(dirpath, fn)
+            name = os.path.relpath(src, site_packages).replace('\\', '/')
+            if not excluded(name):
+                libs.append((src, 'pyz/lib/' + name))
+                if fn.endswith(('.pyd', '.so', '.dll')):
+                    native.add(name.split('/')[0].split('.')[0])
+                elif is_package_data(name):
+                    native.add(name.split('/')[0])
+
+    members += libs
+    if compile:
+        members = compile_members(workdir, members, compile, legacy=True)
+
+    config = {'app': 'pyz/app', 'lib': 'pyz/lib', 'native': {}}
+    for src, name in members:
+        if not name.startswith('pyz/lib/'):
+            continue
+        top = name.split('/')[2].split('.')[0]
+        if top in native:
+            config['native'].setdefault(top, []).append(name)
+    marker = os.path.join(workdir, 'zipimport.json')
+    with open(marker, 'w') as f:
+        json.dump(config, f, indent=1, sort_keys=True)
+    return members + [(marker, 'feet/zipimport.json')]
+
+
+class LazyExtensionFinder:
+    # Imports packages listed as native in zipimport.json, those with native
+    # extensions or data files, from disk, after extracting their members
+    # from the exe the first time one is imported.
+
+    def __init__(self, archive, prefix, native, dest):
+        self.archive = archive
+        self.prefix = prefix + '/'
+        self.native = native
+        self.dest = dest
+
+    def find_spec(self, fullname, path=None, target=None):
+        if path is not None or fullname not in self.native:
+            return None
+        from importlib.machinery import PathFinder
+        return PathFinder.find_spec(fullname, [self.extract(fullname)])
+
+    def extract(self, name):
+        import shutil
+        import zipfile
+
+        dest = os.path.join(self.dest, name)
+        if os.path.isdir(dest):
+            return dest
+        tmp = dest + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        with zipfile.ZipFile(self.archive) as zf:
+            for member in self.native[name]:
+                path = os.path.join(tmp, *member[len(self.prefix):].split('/'))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with zf.open(member) as src, open(path, 'wb') as f:
+                    shutil.copyfileobj(src, f)
+        try:
+            os.replace(tmp, dest)
+        except OSError:
+            # Another launch got there first
+            shutil.rmtree(tmp, ignore_errors=True)
+        return dest
+
+
+def run_from_archive(exe):
+    # Run the app without extracting it: app code and pure Python libraries
+    # are imported from the exe by zipimport, the way `python main.py` would
+    # import them from disk.
+    import json
+    import runpy
+
+    with open(os.path.join(root, 'zipimport.json')) as f:
+        config = json.load(f)
+    paths = [os.path.join(exe, *config[key].split('/')) for key in ('app', 'lib')]
+    feet_paths = ('.', root, site_packages, os.path.join(sys.executable, 'Lib', 'site-packages'))
+    sys.path[:] = paths + [p for p in sys.path if p not in feet_paths]
+    sys.meta_path.insert(0, LazyExtensionFinder(exe, config['lib'], config['native'], os.path.join(root, 'lazy')))
+    os.environ['PYTHONPATH'] = os.pathsep.join(paths)
+    os.chdir(os.path.dirname(root))
+    sys.argv = [os.path.join(paths[0], 'main.py')]
+    runpy.run_module('main', run_name='__main__', alter_sys=True)
+    return 0
+
+
+def extract_path(name):
+    # Mirror the bootloader: runtime members under feet/ land in the data
+    # directory, everything else beside the exe.
+    if name.startswith('feet/'):
+        return os.path.join(root, *name[len('feet/'):].split('/'))
+    return os.path.join(os.path.dirname(root), *name.split('/'))
+
+
+def bundle_manifests(zf):
+    import json
+
+    try:
+        meta = json.loads(zf.comment)
+    except ValueError:
+        meta = {}
+    names = [meta.get('feet_app_manifest'), meta.get('feet_manifest', 'feet/manifest.json')]
+    return [name for name in names if name and name in zf.NameToInfo]
+
+
+def stale_files(files):
+    stale = []
+    for name, (size, digest) in sorted(files.items()):
+        path = extract_path(name)
+        try:
+            if os.stat(path).st_size == size and hash_file(path) == digest:
+                continue
+        except OSError:
+            pass
+        stale.append(name)
+    return stale
+
+
+def replace_file(src, dest):
+    try:
+        os.replace(src, dest)
+    except PermissionError:
+        # Windows won't replace a file that is in use, like the running
+        # python.exe, but it can still be renamed out of the way
+        aside = dest + '.old'
+        if os.path.exists(aside):
+            os.unlink(aside)
+        os.replace(dest, aside)
+        os.replace(src, dest)
+
+
+def extract_member(zf, name, path):
+    import shutil
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    info = zf.getinfo(name)
+    tmp = path + '.tmp'
+    with zf.open(info) as src, open(tmp, 'wb') as dest:
+        shutil.copyfileobj(src, dest)
+    mode = info.external_attr >> 16
+    if mode & 0o777:
+        os.chmod(tmp, mode & 0o777)
+    replace_file(tmp, path)
+
+
+def sync_runtime(exe, check=False):
+    import json
+    import shutil
+    import zipfile
+
+    with zipfile.ZipFile(exe) as zf:
+        manifests = bundle_manifests(zf)
+        if not manifests:
+            print("This exe has no manifest to check the runtime against.")
+            return 1
+        files = {}
+        for manifest in manifests:
+            files.update(json.loads(zf.read(manifest))['files'])
+        # Archived app files are imported from the exe, never extracted, and
+        # a shared runtime is only ever extracted whole by the bootloader
+        skip = ('pyz/', 'feet/cpython/') if shared_runtime else ('pyz/',)
+        files = {name: entry for name, entry in files.items() if not name.startswith(skip)}
+        stale = stale_files(files)
+
+        if check:
+            for name in stale:
+                print("Differs:", extract_path(name))
+            print(f"{len(stale)} files differ from {os.path.basename(exe)}")
+            return 1 if stale else 0
+
+        for name in stale:
+            extract_member(zf, name, extract_path(name))
+
+        # Runtime files dropped since the last version are removed, judged by
+        # the manifest that was extracted with them
+        old = os.path.join(root, 'manifest.json')
+        if os.path.exists(old):
+            with open(old) as f:
+                dropped = set(json.load(f)['files'])
+            dropped.difference_update(files)
+            for name in sorted(dropped):
+                path = extract_path(name)
+                if name.startswith('feet/') and os.path.exists(path):
+                    os.unlink(path)
+
+        # The manifests go last, the runtime one after the app one: the
+        # bootloader takes a data directory newer than the exe as current.
+        for manifest in manifests:
+            extract_member(zf, manifest, extract_path(manifest))
+
+    # Natives extracted for zipimport runs come from the old exe
+    shutil.rmtree(os.path.join(root, 'lazy'), ignore_errors=True)
+    # as does a private runtime replaced by a shared one. The libraries
+    # installed into it go with it, so the records that they were installed
+    # go too, and the next launch installs them into the app's site-packages.
+    if shared_runtime and os.path.isdir(os.path.join(root, 'cpython')):
+        shutil.rmtree(os.path.join(root, 'cpython'), ignore_errors=True)
+        for path in (requirements_state, os.path.join(root, 'requirements_installed.txt')):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    print(f"Updated {len(stale)} files from {os.path.basename(exe)}")
+    return 0
+
+
+PATCH_MAGIC = b'FEETPATCH 1\n'
+
+
+def archive_segments(path):
+    import zipfile
+
+    # Split a file into the stretches a delta can reuse between releases:
+    # whatever precedes the archive (the runner), each member's record, and
+    # the central directory through to the end.
+    size = os.path.getsize(path)
+    try:
+        with zipfile.ZipFile(path) as zf:
+            offsets = sorted(info.header_offset for info in zf.infolist())
+            end = zf.start_dir
+    except zipfile.BadZipFile:
+        return [(0, size)]
+    bounds = [0] + offsets + [end, size]
+    return [(start, stop - start) for start, stop in zip(bounds, bounds[1:]) if stop > start]
+
+
+def segment_digests(path):
+    import hashlib
+
+    with open(path, 'rb') as f:
+        for offset, length in archive_segments(path):
+            f.seek(offset)
+            digest = hashlib.sha256()
+            remaining = length
+            while remaining:
+                chunk = f.read(min(remaining, 1 << 20))
+                digest.update(chunk)
+                remaining -= len(chunk)
+            yield offset, length, digest.hexdigest()
+
+
+def make_patch(old, new, output):
+    import json
+    import lzma
+
+    # Archives are reproducible, so every member that didn't change between
+    # releases is byte-identical and becomes a copy from the old file. Only
+    # the rest is shipped, lzma compressed.
+    known = {(length, digest): offset for offset, length, digest in segment_digests(old)}
+    ops = []
+    for offset, length, digest in segment_digests(new):
+        if (length, digest) in known:
+            op = ['copy', known[length, digest], length]
+            if ops and ops[-1][0] == 'copy' and ops[-1][1] + ops[-1][2] == op[1]:
+                ops[-1][2] += length
+                continue
+        else:
+            op = ['data', offset, length]
+            if ops and ops[-1][0] == 'data' and ops[-1][1] + ops[-1][2] == offset:
+                ops[-1][2] += length
+                continue
+        ops.append(op)
+
+    header = {
+        'old': {'size': os.path.getsize(old), 'sha256': hash_file(old)},
+        'new': {'size': os.path.getsize(new), 'sha256': hash_file(new)},
+        'ops': [['copy', op[1], op[2]] if op[0] == 'copy' else ['data', op[2]] for op in ops],
+    }
+    with open(output, 'wb') as f:
+        f.write(PATCH_MAGIC)
+        with lzma.LZMAFile(f, 'wb') as payload, open(new, 'rb') as src:
+            payload.write(json.dumps(header).encode('utf8') + b'\n')
+            for op in ops:
+                if op[0] == 'data':
+                    src.seek(op[1])
+                    copy_bytes(src, payload, op[2])
+
+    size = os.path.getsize(output)
+    print(f"Wrote {output}, {size} bytes ({size / max(header['new']['size'], 1):.1%} of {os.path.basename(new)})")
+    return 0
+
+
+def apply_patch(patch, target, output):
+    import json
+    import lzma
+    import shutil
+
+    with open(patch, 'rb') as f:
+        if f.readline() != PATCH_MAGIC:
+            print(f"{patch} is not a Feet patch.")
+            return 1
+        with lzma.LZMAFile(f) as payload:
+            header = json.loads(payload.readline())
+            if (os.path.getsize(target), hash_file(target)) != (header['old']['size'], header['old']['sha256']):
+                print(f"{patch} does not apply to {target}, which is not the version it was made from.")
+                return 1
+
+            tmp = output + '.tmp'
+            with open(target, 'rb') as old, open(tmp, 'wb') as new:
+                for op in header['ops']:
+                    if op[0] == 'copy':
+                        old.seek(op[1])
+                        copy_bytes(old, new, op[2])
+                    else:
+                        copy_bytes(payload, new, op[1])
+
+    if hash_file(tmp) != header['new']['sha256']:
+        os.unlink(tmp)
+        print(f"Applying {patch} produced a corrupt file, {target} was left alone.")
+        return 1
+    shutil.copymode(target, tmp)
+    replace_file(tmp, output)
+    print(f"Updated {output}")
+    return 0
+
+
+def run_in_process(main):
+    # Run main.py in this interpreter the way `python main.py` would in a
+    # child: from its own directory, with that directory first on sys.path,
+    # the project libraries after it, and the script as __main__.
+    import runpy
+
+    app_dir = os.path.dirname(main)
+    feet_paths = ('.', root, site_packages, os.path.join(sys.executable, 'Lib', 'site-packages'))
+    sys.path[:] = [app_dir, site_packages] + [p for p in sys.path if p not in feet_paths]
+    sys.argv = [main]
+    os.environ['PYTHONPATH'] = site_packages
+    os.chdir(app_dir)
+    runpy.run_path(main, run_name='__main__')
+    return 0
+
+
+# Profiles main.py run as __main__ the way `python main.py` would, keeping
+# its exit code, which `python -m cProfile` swallows
+PROFILE_SCRIPT = '''
+import cProfile, os, runpy, sys
+out, main = sys.argv[1], sys.argv[2]
+sys.argv = sys.argv[2:]
+sys.path[0] = os.path.dirname(main)
+profile = cProfile.Profile()
+try:
+    profile.runcall(runpy.run_path, main, run_name='__main__')
+finally:
+    profile.dump_stats(out)
+'''
+
+
+def spawn_app(py_bin, main, flags=(), **kwargs):
+    # Start main.py in a child interpreter the way `run` does: from its own
+    # directory, with the project libraries on PYTHONPATH.
+    env = os.environ.copy()
+    env.update({
+        'PYTHONPATH': ':'.join((
+            site_packages,
+        )),
+    })
+    options = {'stdout': sys.stdout, 'stderr': sys.stderr, 'stdin': sys.stdin}
+    options.update(kwargs)
+    return subprocess.Popen(
+        [py_bin, *flags, main],
+        cwd=os.path.dirname(main),
+        env=env,
+        **options,
+    )
+
+
+class ForkedApp:
+    # main.py run in a fork of this process, starting with everything the
+    # process has imported already, and with as much of Popen's interface
+    # as the watcher needs.
+
+    def __init__(self, main):
+        # Nothing the watcher printed may be left buffered for the child to
+        # print again
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.returncode = None
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 1
+            try:
+                run_in_process(main)
+                status = 0
+            except SystemExit as e:
+                if e.code is None:
+                    status = 0
+                elif isinstance(e.code, int):
+                    status = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+            finally:
+                # os._exit() skips interpreter shutdown, so run the app's
+                # atexit handlers and flush its output as `python main.py`
+                # would on exit
+                import atexit
+                atexit._run_exitfuncs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+
+    def _reap(self, flags):
+        pid, status = os.waitpid(self.pid, flags)
+        if pid:
+            self.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    def poll(self):
+        if self.returncode is None:
+            self._reap(os.WNOHANG)
+        return self.returncode
+
+    def terminate(self):
+        import signal
+
+        if self.poll() is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+    def wait(self):
+        if self.returncode is None:
+            self._reap(0)
+        return self.returncode
+
+
+def project_snapshot(excluded):
+    # Modification times and sizes of the files a bundle would include
+    snapshot = {}
+    for src, name in walk_files('.', excluded):
+        try:
+            st = os.stat(src)
+        except OSError:
+            continue
+        snapshot[name] = (st.st_mtime_ns, st.st_size)
+    return snapshot
+
+
+def watch_app(py_bin, main, preload=(), interval=0.25):
+    import importlib
+    import time
+
+    # Runs main.py again whenever a project file changes, found by polling
+    # their stats. Where the OS can fork, every run is a fork of this
+    # process, so modules preloaded here once are already imported and a
+    # restart takes milliseconds. Elsewhere each run is a new interpreter.
+    os.chdir(os.path.dirname(main))
+    excluded = compile_excludes(zip_excludes)
+    fork = hasattr(os, 'fork')
+    if fork:
+        for name in preload:
+            start = time.perf_counter()
+            importlib.import_module(name)
+            print(f"Preloaded {name} in {(time.perf_counter() - start) * 1000:.0f}ms")
+    elif preload:
+        print("Preloading needs os.fork(); every run starts a new interpreter instead")
+
+    snapshot = project_snapshot(excluded)
+    app = None
+    try:
+        while True:
+            update_libraries_for_run(py_bin)
+            app = ForkedApp(main) if fork else spawn_app(py_bin, main)
+            reported = False
+            while True:
+                time.sleep(interval)
+                if app.poll() is not None and not reported:
+                    print(f"{os.path.basename(main)} exited with {app.returncode}, waiting for changes...")
+                    reported = True
+                current = project_snapshot(excluded)
+                if current != snapshot:
+                    break
+            changed = sorted(name for name in set(current) | set(snapshot) if current.get(name) != snapshot.get(name))
+            snapshot = current
+            app.terminate()
+            app.wait()
+            more = f" and {len(changed) - 1} more" if len(changed) > 1 else ""
+            print(f"Restarting, {changed[0]}{more} changed")
+    except KeyboardInterrupt:
+        if app:
+            app.terminate()
+            app.wait()
+        return 0
+
+
+def importtime_report(lines, top=30):
+    # Rank the modules reported by -X importtime by cumulative time, which
+    # includes everything they imported in turn
+    rows = []
+    for line in lines:
+        fields = line[len('import time:'):].split('|')
+        try:
+            rows.append((int(fields[1]), int(fields[0]), fields[2].strip()))
+        except (IndexError, ValueError):
+            continue
+    rows.sort(reverse=True)
+    report = [f"{'cumulative':>12} {'self':>10}  module"]
+    for cumulative, self_time, name in rows[:top]:
+        report.append(f"{cumulative / 1000:10.1f}ms {self_time / 1000:8.1f}ms  {name}")
+    report.append(f"{len(rows)} modules imported in {sum(row[1] for row in rows) / 1000:.1f}ms")
+    return report
+
+
+def run_profile_imports(py_bin, main):
+    proc = spawn_app(py_bin, main, ['-X', 'importtime'], stderr=subprocess.PIPE, universal_newlines=True)
+    lines = []
+    for line in proc.stderr:
+        if line.startswith('import time:'):
+            lines.append(line)
+        else:
+            sys.stderr.write(line)
+    code = proc.wait()
+    print('\n'.join(importtime_report(lines)))
+    return code
+
+
+def collapsed_stacks(stats):
+    # Rebuild call stacks for flame graph tools from the caller/callee pairs
+    # cProfile records. A function's time is split between the stacks that
+    # reach it in proportion to the time each caller spent in it.
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(func)
+
+    def label(func):
+        filename, line, name = func
+        if filename == '~':
+            return name
+        return f"{name} ({os.path.basename(filename)}:{line})"
+
+    stacks = {}
+    total = sum(tt for cc, nc, tt, ct, callers in stats.values()) or 1
+
+    def walk(func, stack, share):
+        cc, nc, tt, ct, callers = stats[func]
+        stack = stack + [label(func)]
+        key = ';'.join(stack)
+        stacks[key] = stacks.get(key, 0) + tt * share
+        for callee in callees.get(func, ()):
+            callee_ct = stats[callee][3]
+            edge_ct = stats[callee][4][func][3]
+            if callee_ct and label(callee) not in stack:
+                child_share = share * edge_ct / callee_ct
+                if child_share * callee_ct > total * 1e-5:
+                    walk(callee, stack, child_share)
+
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        if not callers:
+            walk(func, [], 1.0)
+    return [f"{stack} {round(value * 1e6)}" for stack, value in sorted(stacks.items()) if round(value * 1e6)]
+
+
+def run_profile(py_bin, main, output):
+    import pstats
+
+    output = os.path.abspath(output)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    code = spawn_app(py_bin, main, ['-c', PROFILE_SCRIPT, output]).wait()
+    if not os.path.exists(output):
+        print("The app exited before a profile was written.")
+        return code or 1
+    collapsed = os.path.splitext(output)[0] + '.collapsed'
+    with open(collapsed, 'w') as f:
+        for line in collapsed_stacks(pstats.Stats(output).stats):
+            f.write(line + '\n')
+    print(f"Wrote {output} and {collapsed}")
+    return code
+
+
+def parse_requirement(line):
+    # Split a requirement line into a normalized project name and the line
+    # itself, without pulling in pkg_resources or packaging. Lines that are
+    # not requirements, like pip options or URLs, have no name.
+    import re
+
+    line = re.sub(r'(^|\s)#.*', '', line).strip()
+    if not line:
+        return None
+    match = re.match(r'([A-Za-z0-9][A-Za-z0-9._-]*)(|[\s\[(<>=!~;@].*)$', line)
+    if not match:
+        return None, line
+    name, rest = match.groups()
+    return re.sub(r'[-_.]+', '-', name).lower(), name + rest
+
+
+def installed_versions():
+    # Read names and versions straight from the metadata directory names,
+    # which is far cheaper than loading every distribution's metadata.
+    installed = {}
+    if os.path.isdir(site_packages):
+        for entry in os.listdir(site_packages):
+            base, ext = os.path.splitext(entry)
+            if ext in ('.dist-info', '.egg-info'):
+                name, _, version = base.partition('-')
+                key, _ = parse_requirement(name)
+                installed[key] = version.split('-')[0]
+    return installed
+
+
+def unsatisfied_requirements(requirements):
+    # Returns the requirement lines pip still has to install, or None when
+    # the file has lines only pip itself understands.
+    installed = installed_versions()
+    Requirement = None
+    missing = []
+    for key, line in requirements:
+        if key is None:
+            return None
+        req = None
+        if any(c in line for c in '<>=!~;'):
+            # Only specifiers and markers need the full requirement parser
+            if Requirement is None:
+                try:
+                    from packaging.requirements import Requirement
+                except ImportError:
+                    from pip._vendor.packaging.requirements import Requirement
+            req = Requirement(line)
+            if req.marker and not req.marker.evaluate():
+                continue
+        if key not in installed:
+            missing.append(line)
+        elif req and not req.specifier.contains(installed[key], prereleases=True):
+            missing.append(line)
+    return missing
+
+
+def read_requirements_state():
+    try:
+        with open(requirements_state) as f:
+            digest, size, mtime = f.read().split()
+        return digest, int(size), int(mtime)
+    except (OSError, ValueError):
+        return None
+
+
+def requirements_changed(path='requirements.txt'):
+    # Cheap enough for every launch: a stat and a tiny read
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    state = read_requirements_state()
+    return state is None or state[1:] != (st.st_size, st.st_mtime_ns)
+
+
+def wheel_cache():
+    # An optional wheel directory shared by every project on the machine
+    return os.getenv('FEET_WHEEL_CACHE')
+
+
+def pip_install(py_bin, requirements, upgrade=False):
+    upgrade = ['-U'] if upgrade else []
+    # Never install into a runtime other apps share
+    if shared_runtime:
+        upgrade += ['--target', site_packages]
+    cache = wheel_cache()
+    if not cache:
+        subprocess.check_call([py_bin, '-m', 'pip', 'install', '--trusted-host=pypi.org', *upgrade, *requirements])
+        return
+
+    # Install from the shared cache without touching an index, and only
+    # download and build into the cache what it doesn't have yet.
+    os.makedirs(cache, exist_ok=True)
+    offline = [py_bin, '-m', 'pip', 'install', '--no-index', '--find-links', cache, *upgrade, *requirements]
+    if subprocess.call(offline, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL):
+        subprocess.check_call([py_bin, '-m', 'pip', 'wheel', '--trusted-host=pypi.org',
+                               '--find-links', cache, '-w', cache, *requirements])
+        subprocess.check_call(offline)
+
+
+def build_wheelhouse(py_bin, workdir, path='requirements.txt'):
+    # Resolve and build every requirement once, at packaging time, and pin
+    # the result so first runs install with no index and no resolver.
+    import shutil
+
+    if not os.path.exists(path):
+        return []
+
+    wheelhouse = os.path.join(workdir, 'wheelhouse')
+    links = ['--find-links', wheel_cache()] if wheel_cache() else []
+    subprocess.check_call([py_bin, '-m', 'pip', 'wheel', '--trusted-host=pypi.org',
+                           *links, '-w', wheelhouse, '-r', path])
+
+    lock = os.path.join(workdir, 'requirements.lock')
+    wheels = sorted(os.listdir(wheelhouse))
+    with open(lock, 'w') as f:
+        for wheel in wheels:
+            name, version = wheel.split('-')[:2]
+            f.write(f'{name}=={version}\n')
+    if wheel_cache():
+        for wheel in wheels:
+            shutil.copy(os.path.join(wheelhouse, wheel), wheel_cache())
+
+    members = [(lock, 'requirements.lock')]
+    members += [(os.path.join(wheelhouse, wheel), f'wheelhouse/{wheel}') for wheel in wheels]
+    return members
+
+
+def requirements_file():
+    # Bundles built with --wheels carry a lock file and the wheels it pins
+    if os.path.isdir('wheelhouse') and os.path.exists('requirements.lock'):
+        return 'requirements.lock'
+    return 'requirements.txt'
+
+
+def update_libraries(py_bin, path=None):
+    import hashlib
+
+    path = path or requirements_file()
+    if path == 'requirements.lock':
+        pip_args = ['--no-index', '--no-deps', '--find-links', 'wheelhouse']
+    else:
+        pip_args = []
+
+    with open(path, 'rb') as f:
+        content = f.read()
+    st = os.stat(path)
+    digest = hashlib.sha256(content).hexdigest()
+
+    state = read_requirements_state()
+    if not state or state[0] != digest:
+        requirements = filter(None, map(parse_requirement, content.decode('utf8').splitlines()))
+        missing = unsatisfied_requirements(requirements)
+        if missing is None:
+            pip_install(py_bin, [*pip_args, '-r', path], upgrade=True)
+        elif missing:
+            pip_install(py_bin, [*pip_args, *missing])
+
+    with open(requirements_state, 'w') as f:
+        f.write(f'{digest} {st.st_size} {st.st_mtime_ns}\n')
+
+
+def update_libraries_for_run(py_bin):
+    # A failed install, offline or for a bad requirement, must not keep the
+    # app from starting. The state file isn't written, so the next launch
+    # tries again.
+    if not requirements_changed(requirements_file()):
+        return
+    try:
+        update_libraries(py_bin)
+    except subprocess.CalledProcessError as e:
+        print(f"Warning: installing libraries failed (pip exited with {e.returncode}), "
+              "starting without them", file=sys.stderr)
+
+
+def add_libraries(py_bin, specs, files=()):
+    cur_libraries = {}
+    if os.path.exists('requirements.txt'):
+        with open('requirements.txt') as f:
+            for key, req in filter(None, map(parse_requirement, f)):
+                cur_libraries[key or req] = req
+
+    # Blank and comment-only specs are skipped, as they are in files
+    specs = [spec for spec in specs if parse_requirement(spec)]
+    if not specs and not files:
+        print("Name the libraries to install, like `feet library pygame`, or a file of them with -r.")
+        return 1
+
+    new_libraries = [parse_requirement(spec) for spec in specs]
+    pip_args = list(specs)
+    for path in files:
+        with open(path) as f:
+            new_libraries.extend(filter(None, map(parse_requirement, f)))
+        pip_args += ['-r', path]
+    for key, req in new_libraries:
+        cur_libraries[key or req] = req
+
+    # Everything is resolved and installed together in a single pip run, and
+    # requirements.txt is only replaced once that succeeded.
+    pip_install(py_bin, pip_args)
+
+    print("Updating project requirements.txt file...")
+    with open('requirements.txt.tmp', 'w') as f:
+        for req in cur_libraries.values():
+            f.write(f'{req}\n')
+    os.replace('requirements.txt.tmp', 'requirements.txt')
+
 
 def main(argv):
     feet_exec = argv.pop(0)
-    args = parser.parse_args(argv)
+    # The plain launch path doesn't need argparse at all
+    if not argv or argv == ['run']:
+        command, args = 'run', None
+    else:
+        args = make_parser().parse_args(argv)
+        command = args.command or 'run'
 
     assert os.path.exists(feet_bin)
-    py_bin = os.path.join(root, "cpython", "python.exe")
+    py_bin = os.path.join(runtime_dir, "python.exe")
+
+    if command in ('verify', 'sync'):
+        return sync_runtime(feet_bin, check=command == 'verify')
+    if command == 'patch':
+        return make_patch(args.old, args.new, args.output or os.path.splitext(args.new)[0] + '.feetpatch')
+    if command == 'apply':
+        target = args.target or feet_bin
+        return apply_patch(args.patch, target, args.output or target)
+    if command == 'run' and os.path.exists(os.path.join(root, 'zipimport.json')):
+        return run_from_archive(feet_bin)
     
     main = os.path.join(root, "app", "main.py")
     if not os.path.exists(main):
@@ -144,28 +1325,27 @@ def main(argv):
         print(HELP)
         exit(1)
 
-    if args.command == 'run' or not args.command:
-        env = os.environ.copy()
-        env.update({
-            'PYTHONPATH': ':'.join((
-                site_packages,
-            )),
-        })
-        proc = subprocess.Popen(
-            [py_bin, main],
-            cwd=os.path.dirname(main),
-            env=env,
-            stdout=sys.stdout,
-            stderr=sys.stderr,
-            stdin=sys.stdin,
-        )
+    if command == 'run':
+        update_libraries_for_run(py_bin)
+
+        if getattr(args, 'profile_imports', False):
+            sys.exit(run_profile_imports(py_bin, main))
+        if getattr(args, 'profile', None):
+            sys.exit(run_profile(py_bin, main, args.profile))
+        if getattr(args, 'watch', False):
+            return watch_app(py_bin, main, args.preload)
+
+        if getattr(args, 'in_process', os.getenv('FEET_IN_PROCESS') == '1'):
+            return run_in_process(main)
+
+        proc = spawn_app(py_bin, main)
         sys.exit(proc.wait())
     
-    elif args.command == 'setup':
+    elif command == 'setup':
         print('Python Feet environemnt ready for use!')
         return 0
 
-    elif args.command == 'shell':
+    elif command == 'shell':
         try:
             import readline # optional, will allow Up/Down/History in the console
         except ImportError:
@@ -176,35 +1356,28 @@ def main(argv):
         shell = code.InteractiveConsole(variables)
         shell.interact()
 
-    elif args.command == 'library':
+    elif command == 'library':
         if args.update:
             if os.path.exists('requirements.txt'):
-                subprocess.check_call([py_bin, '-m', 'pip', 'install', '--trusted-host=pypi.org', '-Ur', 'requirements.txt'])
+                update_libraries(py_bin)
             else:
                 print("This project has no Python libraries listed in a requirements.txt file.")
                 print("Use `feet libary some-library` to install libraries from Python's ecosystem to your project.")
 
-        else:
-            cur_libraries = {}
+        elif args.spec or args.requirements:
+            return add_libraries(py_bin, args.spec, args.requirements)
 
-            if os.path.exists('requirements.txt'):
-                for req in pkg_resources.parse_requirements(open('requirements.txt')):
-                    cur_libraries[req.name] = req.specifier
-            new_req = list(pkg_resources.parse_requirements(args.spec))[0]
-            cur_libraries[new_req.name] = new_req.specifier
-
-            args = ['install', '--trusted-host=pypi.org', args.spec]
-            subprocess.check_call([py_bin, '-m', 'pip', *args])
-
-            print("Updating project requirements.txt file...")
-            with open('requirements.txt', 'w') as f:
-                for name, spec in cur_libraries.items():
-                    f.write(f'{name}{spec}\n')
+        else:
+            print("Name the libraries to install, like `feet library pygame`, or a file of them with -r.")
+            return 1
     
-    elif args.command == 'exe':
+    elif command == 'exe':
         if not args.confirm:
             print("The exe packing command is experimental. Use --confirm to confirm opting into using it.")
             exit(1)
+        if args.zipimport and args.wheels:
+            print("--zipimport already bundles your installed libraries, leave out --wheels.")
+            return 1
         name = args.name
         if not name.endswith('.exe'):
             name += ".exe"
@@ -214,18 +1387,22 @@ def main(argv):
                 os.mkdir('dist')
 
 
-        shutil.copy(feet_bin, name)
-        include = get_app_files(args.files, exclude=[feet_bin])
-        prefix = '.'
-
-        zf = zipfile.ZipFile(name, 'a', zipfile.ZIP_BZIP2)
-        for f in include:
-            zf.write(f, os.path.join(prefix, f))
-        zf.close()
-
-        add_to_zip(".", name, zipfile.ZIP_BZIP2, prefix=prefix)
+        import tempfile
+        import zipfile
+        with tempfile.TemporaryDirectory() as workdir:
+            if args.zipimport:
+                # zipimport can only read stored and deflated members
+                members = pyz_members(workdir, args.files, exclude=[feet_bin], compile=args.compile)
+                compression = zipfile.ZIP_DEFLATED
+            else:
+                extra = build_wheelhouse(py_bin, workdir) if args.wheels else []
+                members = collect_members(args.files, exclude=[feet_bin], prefix='.', extra=extra)
+                if args.compile:
+                    members = compile_members(workdir, members, args.compile, keep=['main.py'])
+                compression = zipfile.ZIP_BZIP2
+            write_bundle(name, members, compression, base=feet_bin, manifest='feet/app_manifest.json')
     
-    elif args.command == 'zip':
+    elif command == 'zip':
         name = args.name
         if not name.endswith('.zip'):
             name += ".zip"
@@ -234,14 +1411,14 @@ def main(argv):
         if not os.path.exists("dist"):
             os.makedirs("dist")
         
-        include = get_app_files(args.files)
-
-        zf = zipfile.ZipFile(name, 'a', zipfile.ZIP_DEFLATED)
-        for f in include:
-            zf.write(f, f)
-        zf.close()
-
-        add_to_zip(".", name, zipfile.ZIP_DEFLATED, prefix=".")
+        import tempfile
+        import zipfile
+        with tempfile.TemporaryDirectory() as workdir:
+            extra = build_wheelhouse(py_bin, workdir) if args.wheels else []
+            members = collect_members(args.files, prefix='.', extra=extra)
+            if args.compile:
+                members = compile_members(workdir, members, args.compile, keep=['main.py'])
+            write_bundle(name, members, zipfile.ZIP_DEFLATED)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import fnmatch
+import functools
+import glob
+import hashlib
 import json
 import logging
 import os
+import re
 import shutil
+import struct
 import subprocess
 import sys
+import time
 import zipfile
+import zlib
 
 
 logger = logging.getLogger(__name__)
@@ -20,8 +28,22 @@ subparsers = parser.add_subparsers(dest='command')
 
 build_parser = subparsers.add_parser('build')
 build_parser.add_argument('--debug', action='store_true')
+build_parser.add_argument('--staging', dest='staging', action='store', default=os.path.join('build', 'staging'), metavar='DIR')
+build_parser.add_argument('--stub', dest='stub', action='store', default=None, metavar='PATH')
+build_parser.add_argument('--staging-mode', dest='staging_mode', action='store', default='copy', choices=['copy', 'link', 'direct'])
 build_parser.add_argument('-o', action='store', default=None, dest='output')
-build_parser.add_argument('-a', '--arch', dest='arch', action='store', default='win32', choices=['win32', 'amd64'])
+build_parser.add_argument('-a', '--arch', dest='arch', action='append', default=None, choices=['win32', 'amd64'])
+build_parser.add_argument('-j', '--jobs', dest='jobs', action='store', type=int, default=os.cpu_count() or 1)
+build_parser.add_argument('--no-cache', dest='no_cache', action='store_true')
+build_parser.add_argument('--bytecode', dest='bytecode', action='store_true')
+build_parser.add_argument('--optimize', dest='optimize', action='store', type=int, default=0, choices=[0, 1, 2])
+build_parser.add_argument('--compression', dest='compression', action='store', default='bzip2', choices=['stored', 'deflate', 'bzip2'])
+build_parser.add_argument('--prune-for', dest='prune_for', action='store', default=None, metavar='MAIN')
+build_parser.add_argument('--keep', dest='keep', action='append', default=[], metavar='MODULE')
+build_parser.add_argument('--trace', dest='trace', action='store_true')
+build_parser.add_argument('--shared-runtime', dest='shared_runtime', action='store_true')
+build_parser.add_argument('--report', dest='report', action='store', default=None, metavar='REPORT_JSON')
+build_parser.add_argument('--compresslevel', dest='compresslevel', action='store', type=int, default=9, choices=range(0, 10), metavar='{0-9}')
 
 clean_parser = subparsers.add_parser('clean')
 
@@ -29,11 +51,25 @@ setup_parser = subparsers.add_parser('setup')
 
 python_parser = subparsers.add_parser('python')
 python_parser.add_argument('-p', dest='pyversion', action='store', default='v3.8.2')
-python_parser.add_argument('-a', '--arch', dest='arch', action='store', default='win32', choices=['win32', 'amd64'])
+python_parser.add_argument('-a', '--arch', dest='arch', action='append', default=None, choices=['win32', 'amd64'])
 
-version = open("VERSION.txt").read()
+version = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "VERSION.txt")).read()
+
+# Codecs the runtime archive can be written with. The bootloader's zip crate
+# is built with deflate and bzip2 support only, so lzma is left out here even
+# though benchmarks/bench_codecs.py measures it.
+compressions = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+}
 python_loc_default = "cpython"
 python_loc = os.getenv("FEET_PYTHON_DIR", python_loc_default)
+cache_dir = os.path.join("build", "cache")
+
+# Archive members get a fixed timestamp and normalized permissions, so the
+# same inputs always produce byte-identical archives
+zip_date_time = (1980, 1, 1, 0, 0, 0)
 
 # These patterns will be excluded from the generated Zip archives
 zip_excludes = [
@@ -49,6 +85,54 @@ zip_excludes = [
     '*test_*',
 ]
 
+# Archives built with --bytecode keep the compiled files these would drop
+bytecode_excludes = [
+    pattern for pattern in zip_excludes
+    if pattern not in ('**/__pycache__', '**/*.pyc')
+] + ['feet/__pycache__*']
+
+# Imports of a typical main.py, timed to report what --bytecode saves
+typical_imports = "import argparse, json, logging, random, datetime, pathlib, subprocess, urllib.request"
+
+# Run by the target interpreter, so the bytecode matches its version. Reads
+# [source, cfile, dfile] triples as JSON from stdin, where a null cfile means
+# the __pycache__ location the interpreter would look in without -O.
+COMPILE_SCRIPT = '''
+import importlib.util, json, py_compile, sys
+optimize = int(sys.argv[1])
+for src, cfile, dfile in json.load(sys.stdin):
+    if cfile is None:
+        cfile = importlib.util.cache_from_source(src, optimization='')
+    try:
+        py_compile.compile(
+            src, cfile, dfile, doraise=True, optimize=optimize,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+        )
+    except py_compile.PyCompileError as e:
+        print("Not compiling", src, "-", str(e).strip().splitlines()[-1])
+'''
+
+# Runs the app's main.py under the target interpreter, recording every module
+# imported through an audit hook, so --prune-for also keeps dynamic imports
+# the static analysis can't see.
+TRACE_SCRIPT = '''
+import json, os, runpy, sys
+out, main = sys.argv[1], sys.argv[2]
+imported = set()
+def hook(event, args):
+    if event == 'import':
+        imported.add(args[0])
+sys.addaudithook(hook)
+sys.argv = sys.argv[2:]
+sys.path[0] = os.path.dirname(main)
+try:
+    runpy.run_path(main, run_name='__main__')
+finally:
+    imported.update(sys.modules)
+    with open(out, 'w') as f:
+        json.dump(sorted(imported), f)
+'''
+
 # These third-party packages will be included in the build
 py_deps = (
     'pip',
@@ -57,6 +141,9 @@ py_deps = (
     # 'pkg_resources',
 )
 
+# The runtime's own script, whose imports a pruned stdlib has to keep
+runtime_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'feet', 'feet.py')
+
 # These first-party modules will be included outside the stdlib archive
 non_zip_modules = (
     'importlib',
@@ -85,8 +172,6 @@ non_zip_modules = (
 
 
 def clean():
-    if os.path.exists("feet/cpython"):
-        shutil.rmtree("feet/cpython")
     for name in os.listdir('build'):
         path = os.path.join('build', name)
         if os.path.isdir(path):
@@ -95,11 +180,80 @@ def clean():
             os.unlink(path)
 
 
-def is_excluded(name):
-    for pattern in zip_excludes:
-        if fnmatch.fnmatch(name, pattern):
-            return True
-    return False
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_tree(path, relto=None, skip=()):
+    relto = relto or path
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(
+            d for d in dirs
+            if os.path.join(root, d) not in skip
+            and not is_excluded(os.path.relpath(os.path.join(root, d), relto))
+        )
+        for file in sorted(files):
+            src = os.path.join(root, file)
+            name = os.path.relpath(src, relto)
+            if not is_excluded(name):
+                entry = f"{name.replace(os.sep, '/')}\0{hash_file(src)}\n"
+                digest.update(entry.encode('utf8'))
+    return digest.hexdigest()
+
+
+def stage_key(*inputs):
+    return hashlib.sha256(json.dumps(inputs).encode('utf8')).hexdigest()
+
+
+def temp_path(path):
+    # Builds for other archs share the cache, so each process writes its own
+    # temporary file before renaming it into place
+    return f"{path}.{os.getpid()}.tmp"
+
+
+# The cache file records which stages a staging directory holds the output of
+def load_cache(staging):
+    try:
+        with open(os.path.join(staging, 'cache.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_cache(staging, cache):
+    os.makedirs(staging, exist_ok=True)
+    with open(os.path.join(staging, 'cache.json'), 'w') as f:
+        json.dump(cache, f, indent=2)
+
+
+def find_non_zip_modules(lib):
+    for name in sorted(os.listdir(lib)):
+        if os.path.splitext(name)[0] in non_zip_modules:
+            yield os.path.join(lib, name), name
+
+
+def normcase(name):
+    return os.path.normcase(name).replace('\\', '/')
+
+
+@functools.lru_cache()
+def compile_excludes(patterns):
+    # One regex for all patterns, with the same semantics as calling
+    # fnmatch.fnmatch() for each of them in turn.
+    if not patterns:
+        return re.compile('(?!)')
+    return re.compile('|'.join(fnmatch.translate(normcase(p)) for p in patterns))
+
+
+def is_excluded(name, patterns=None):
+    if patterns is None:
+        patterns = zip_excludes
+    return compile_excludes(tuple(patterns)).match(normcase(name)) is not None
 
 
 def ignore_excludes(dirname, names):
@@ -112,23 +266,748 @@ def ignore_excludes(dirname, names):
     ]
 
 
-def zipdir(path, relto, dest, compression):
-    zipf = zipfile.ZipFile(dest, 'w', compression, compresslevel=9)
+def member_info(name, st_mode=0, compression=zipfile.ZIP_STORED):
+    zinfo = zipfile.ZipInfo(name, zip_date_time)
+    zinfo.create_system = 3
+    zinfo.external_attr = (0o100755 if st_mode & 0o111 else 0o100644) << 16
+    zinfo.compress_type = compression
+    return zinfo
+
+
+def compress_member(src, name, compression, compresslevel=None):
+    zinfo = member_info(name, os.stat(src).st_mode, compression)
+    if compression == zipfile.ZIP_LZMA:
+        # Compressed data includes an end-of-stream (EOS) marker
+        zinfo.flag_bits |= 0x02
+
+    with open(src, 'rb') as f:
+        data = f.read()
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    digest = hashlib.sha256(data).hexdigest()
+
+    data = compress_data(data, compression, compresslevel)
+    zinfo.compress_size = len(data)
+    return zinfo, data, digest
+
+
+# zipfile has no public API to compress data the way ZipFile.write() does,
+# to read a member without decompressing it or to append one that is
+# already compressed. The three helpers below are the only code here that
+# touches ZipFile internals (_get_compressor, fp, _writecheck, _didModify
+# and start_dir); checked against CPython 3.8, 3.11, 3.12 and 3.13.
+
+def compress_data(data, compression, compresslevel=None):
+    compressor = zipfile._get_compressor(compression, compresslevel)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    return data
+
+
+def read_compressed(zipf, info):
+    # The member's data as stored in the archive, still compressed
+    zipf.fp.seek(info.header_offset)
+    header = zipf.fp.read(zipfile.sizeFileHeader)
+    name_size, extra_size = struct.unpack('<HH', header[26:30])
+    zipf.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_size + extra_size)
+    return zipf.fp.read(info.compress_size)
+
+
+def write_compressed(zipf, zinfo, data):
+    # Append an entry with its data already compressed, laid out exactly as
+    # ZipFile.write() would have written it.
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    zipf.fp.seek(zipf.start_dir)
+    zinfo.header_offset = zipf.fp.tell()
+    zipf._writecheck(zinfo)
+    zipf._didModify = True
+    zipf.fp.write(zinfo.FileHeader(zip64))
+    zipf.fp.write(data)
+    zipf.start_dir = zipf.fp.tell()
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+
+
+def collect_files(path, relto, excludes=None):
+    members = []
+    for root, dirs, files in os.walk(path):
+        # Prune excluded directories so the walk never descends into them
+        dirs[:] = sorted(
+            d for d in dirs
+            if not is_excluded(os.path.relpath(os.path.join(root, d), relto), excludes)
+        )
+        for file in sorted(files):
+            src = os.path.join(root, file)
+            name = os.path.relpath(src, relto)
+            if not is_excluded(name, excludes):
+                members.append((src, name))
+    return members
+
+
+def zipdir(path, relto, dest, compression, jobs=1, excludes=None, compresslevel=9, manifest=None):
     relto = relto or path
 
     if path.endswith('*'):
         path = path[:-2]
-    print("Writing zip file", dest, "from", path)
+    print("Writing zip file", getattr(dest, 'name', dest), "from", path)
 
-    for root, _, files in os.walk(path):
-        
-        for file in files:
-            src = os.path.join(root, file)
-            name = os.path.relpath(src, relto)
-            if not is_excluded(name):
-                zipf.write(src, name)
-    
-    zipf.close()
+    write_zip(dest, collect_files(path, relto, excludes), compression, jobs, compresslevel, manifest)
+
+
+class OffsetFile:
+    # The rest of a file past its first `base` bytes, as a file of its own,
+    # so an archive written through it after the runner keeps its offsets
+    # relative to the start of the archive, as if written separately
+
+    def __init__(self, fp, base):
+        self.fp = fp
+        self.base = base
+        self.name = fp.name
+
+    def tell(self):
+        return self.fp.tell() - self.base
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            offset += self.base
+        return self.fp.seek(offset, whence) - self.base
+
+    def write(self, data):
+        return self.fp.write(data)
+
+    def flush(self):
+        self.fp.flush()
+
+
+def append_file(dest, path, offset=0):
+    # Append the rest of path from offset to dest, copying in the kernel
+    # where the platform can (copy_file_range, then sendfile), otherwise
+    # through a fixed size buffer
+    with open(path, 'rb') as src:
+        length = os.fstat(src.fileno()).st_size - offset
+        dest.flush()
+        pos = dest.tell()
+        copied = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < length:
+                    n = os.copy_file_range(src.fileno(), dest.fileno(), length - copied,
+                                           offset + copied, pos + copied)
+                    if not n:
+                        break
+                    copied += n
+            except OSError:
+                pass
+        if copied < length and hasattr(os, 'sendfile'):
+            try:
+                os.lseek(dest.fileno(), pos + copied, os.SEEK_SET)
+                while copied < length:
+                    n = os.sendfile(dest.fileno(), src.fileno(), offset + copied, length - copied)
+                    if not n:
+                        break
+                    copied += n
+            except OSError:
+                pass
+        dest.seek(pos + copied)
+        src.seek(offset + copied)
+        while copied < length:
+            chunk = src.read(min(length - copied, 1 << 20))
+            if not chunk:
+                raise EOFError(f"{path} ended {length - copied} bytes early")
+            dest.write(chunk)
+            copied += len(chunk)
+
+
+def runtime_id(archive, manifest):
+    # Identifies the cpython directory of a runtime archive by its files'
+    # sizes and hashes, so apps with the same runtime can share one copy
+    with zipfile.ZipFile(archive) as zf:
+        files = json.loads(zf.read(manifest))['files']
+    entries = sorted((name, entry) for name, entry in files.items() if name.startswith('feet/cpython/'))
+    return hashlib.sha256(json.dumps(entries).encode('utf8')).hexdigest()[:32]
+
+
+def set_comment(fp, comment):
+    # An archive written without a comment ends in its end of central
+    # directory record; set the comment length in its last two bytes and
+    # append the comment, without rewriting anything else
+    fp.seek(-2, os.SEEK_END)
+    fp.write(struct.pack('<H', len(comment)))
+    fp.write(comment)
+
+
+def write_zip(dest, members, compression, jobs=1, compresslevel=9, manifest=None):
+    # Members are compressed concurrently (zlib, bz2 and lzma all release
+    # the GIL) but always written sorted by name, so the archive comes out
+    # the same no matter how many workers were used. Only a bounded window
+    # of compressed members is held in memory at once.
+    #
+    # If a manifest name is given, the size and sha256 of every member is
+    # stored in a JSON member of that name, written last, which feet.py
+    # uses to sync an extracted runtime with a newer exe.
+    jobs = max(jobs, 1)
+    if compression == zipfile.ZIP_BZIP2:
+        compresslevel = max(compresslevel, 1)
+    with zipfile.ZipFile(dest, 'w', compression, compresslevel=compresslevel) as zipf, \
+            ThreadPoolExecutor(jobs) as pool:
+        files = {}
+
+        def write(future):
+            zinfo, data, digest = future.result()
+            write_compressed(zipf, zinfo, data)
+            files[zinfo.filename] = [zinfo.file_size, digest]
+
+        pending = []
+        for src, name in sorted(members, key=lambda m: m[1].replace(os.sep, '/')):
+            pending.append(pool.submit(compress_member, src, name, compression, compresslevel))
+            if len(pending) >= jobs * 4:
+                write(pending.pop(0))
+        for future in pending:
+            write(future)
+
+        if manifest:
+            zipf.writestr(member_info(manifest, compression=compression),
+                          json.dumps({'files': files}, indent=1, sort_keys=True))
+
+
+def compile_bytecode(py_exe, sources, optimize, jobs=1):
+    # Compile with unchecked-hash pycs, which are never validated against
+    # their source, so zipimport and extracted runtimes can use them as-is.
+    jobs = max(1, min(jobs, len(sources)))
+    procs = []
+    for i in range(jobs):
+        proc = subprocess.Popen(
+            [py_exe, '-c', COMPILE_SCRIPT, str(optimize)],
+            stdin=subprocess.PIPE,
+            text=True,
+        )
+        procs.append((proc, json.dumps(sources[i::jobs])))
+    for proc, chunk in procs:
+        proc.communicate(chunk)
+    for proc, _ in procs:
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def compile_stdlib(py_exe, lib, dest, workdir, optimize, jobs=1):
+    # zipimport only finds bytecode beside its source, as name.pyc, and
+    # loads it whatever -O level the interpreter runs with.
+    members = collect_files(lib, lib)
+    sources = [
+        (src, os.path.join(workdir, name + 'c'), name.replace(os.sep, '/'))
+        for src, name in members
+        if name.endswith('.py')
+    ]
+    compile_bytecode(py_exe, sources, optimize, jobs)
+    members += [
+        (cfile, name + 'c')
+        for src, cfile, name in sources
+        if os.path.exists(cfile)
+    ]
+    print("Writing zip file", dest, "from", lib, "with bytecode")
+    write_zip(dest, members, zipfile.ZIP_DEFLATED, jobs)
+
+
+def module_files(lib, name):
+    # Archive names of the stdlib files backing a module. Packages bring
+    # their data files along, including non-package subdirectories.
+    base = os.path.join(lib, *name.split('.'))
+    if os.path.isfile(base + '.py'):
+        return [os.path.relpath(base + '.py', lib).replace(os.sep, '/')]
+    if not os.path.isfile(os.path.join(base, '__init__.py')):
+        return []
+    files = [os.path.relpath(os.path.join(base, '__init__.py'), lib).replace(os.sep, '/')]
+    for root, dirs, names in os.walk(base):
+        dirs[:] = sorted(d for d in dirs if not os.path.exists(os.path.join(root, d, '__init__.py')))
+        files += [
+            os.path.relpath(os.path.join(root, n), lib).replace(os.sep, '/')
+            for n in sorted(names) if not n.endswith('.py')
+        ]
+    return files
+
+
+def trace_imports(py_exe, main, workdir):
+    out = os.path.join(workdir, 'trace.json')
+    print("Tracing imports of", main, "- exit the app to finish")
+    subprocess.run([py_exe, '-c', TRACE_SCRIPT, out, os.path.abspath(main)], cwd=os.path.dirname(os.path.abspath(main)))
+    with open(out) as f:
+        return json.load(f)
+
+
+def runtime_modules(site_packages):
+    # Every module of the py_deps packages installed in a staged runtime
+    if not site_packages:
+        return
+    for dep in py_deps:
+        for src, name in collect_files(os.path.join(site_packages, dep), site_packages, excludes=[]):
+            parts = os.path.splitext(name)[0].split(os.sep)
+            if name.endswith('.py') and all(part.isidentifier() for part in parts):
+                yield '.'.join(parts[:-1] if parts[-1] == '__init__' else parts)
+
+
+def reachable_stdlib(lib, main, keep=(), traced=(), site_packages=None):
+    import modulefinder
+
+    # Everything the app, the runtime's own feet.py, the packages installed
+    # into the runtime, the modules kept outside the archive and the
+    # allowlist import, statically, plus whatever a trace saw imported.
+    # Allowlisted packages are kept with all their submodules.
+    app_dir = os.path.dirname(os.path.abspath(main))
+    finder = modulefinder.ModuleFinder(path=[app_dir, lib] + ([site_packages] if site_packages else []))
+    finder.run_script(runtime_script)
+    finder.run_script(main)
+    for name in runtime_modules(site_packages):
+        try:
+            finder.import_hook(name)
+        except (ImportError, SyntaxError):
+            pass
+    for name in non_zip_modules + tuple(keep):
+        try:
+            finder.import_hook(name, fromlist=['*'] if name in keep else None)
+        except ImportError:
+            if name in keep:
+                print("Could not find module to keep:", name)
+
+    names = set(finder.modules) | set(traced) | set(keep)
+    for name in list(names):
+        parts = name.split('.')
+        names.update('.'.join(parts[:i]) for i in range(1, len(parts)))
+    files = set()
+    for name in names:
+        files.update(module_files(lib, name))
+    return files
+
+
+def filter_zip(src, dest, names):
+    # Copy the members backing the given source names, and their bytecode,
+    # into a new archive without compressing them again
+    kept = 0
+    with zipfile.ZipFile(src) as zin, zipfile.ZipFile(dest, 'w') as zout:
+        for info in zin.infolist():
+            name = info.filename
+            if name not in names and not (name.endswith('.pyc') and name[:-1] in names):
+                continue
+            zinfo = member_info(name, info.external_attr >> 16, info.compress_type)
+            zinfo.flag_bits = info.flag_bits
+            zinfo.CRC = info.CRC
+            zinfo.file_size = info.file_size
+            zinfo.compress_size = info.compress_size
+            write_compressed(zout, zinfo, read_compressed(zin, info))
+            kept += 1
+        total = len(zin.infolist())
+    print(f"Pruned {src} to {kept} of {total} files, "
+          f"{os.stat(src).st_size / 1e6:.1f}MB -> {os.stat(dest).st_size / 1e6:.1f}MB")
+
+
+def phase_start():
+    return time.perf_counter(), os.times()
+
+
+def phase_end(report, name, start, bytes_in=0, bytes_out=0, **extra):
+    # CPU time includes waited-for child processes like cargo and pip,
+    # where the platform reports them (os.times() doesn't on Windows)
+    wall, cpu = start
+    now = os.times()
+    report['phases'].append({
+        'name': name,
+        'wall': time.perf_counter() - wall,
+        'cpu': sum(now[:4]) - sum(cpu[:4]),
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out,
+        **extra,
+    })
+
+
+def tree_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+def archive_totals(path):
+    with zipfile.ZipFile(path) as zf:
+        infos = zf.infolist()
+    return {
+        'path': path,
+        'members': len(infos),
+        'uncompressed': sum(info.file_size for info in infos),
+        'compressed': sum(info.compress_size for info in infos),
+        'size': os.stat(path).st_size,
+    }
+
+
+def import_time(py_exe, code=typical_imports, runs=3):
+    # Total of the per-module self times reported by -X importtime, best of
+    # several runs, in seconds.
+    best = None
+    for _ in range(runs):
+        p = subprocess.run([py_exe, '-X', 'importtime', '-c', code], stderr=subprocess.PIPE, text=True)
+        total = 0
+        for line in p.stderr.splitlines():
+            if line.startswith('import time:'):
+                self_us = line.split(':', 1)[1].split('|')[0].strip()
+                if self_us.isdigit():
+                    total += int(self_us)
+        best = total if best is None else min(best, total)
+    return best / 1e6
+
+
+# Bytecode tag of the runtime's interpreter, for compiling modules into a
+# __pycache__ somewhere other than beside their source
+runtime_cache_tag = 'cpython-38'
+
+
+def reflink_file(src, dest):
+    import fcntl
+
+    # A copy-on-write clone sharing the source's data blocks (FICLONE)
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        fcntl.ioctl(fdest.fileno(), 0x40049409, fsrc.fileno())
+    shutil.copystat(src, dest)
+
+
+# How files are staged, in order of preference. A way the filesystem turns
+# out not to support is dropped for the rest of the tree.
+staging_methods = {
+    'copy': [shutil.copy2],
+    'link': [reflink_file, os.link, shutil.copy2],
+}
+
+
+def stage_file(src, dest, methods):
+    for method in list(methods[:-1]):
+        try:
+            method(src, dest)
+            return method
+        except (OSError, ImportError):
+            if os.path.lexists(dest):
+                os.unlink(dest)
+            try:
+                methods.remove(method)
+            except ValueError:
+                # Another thread dropped it first
+                pass
+    methods[-1](src, dest)
+    return methods[-1]
+
+
+def tree_pairs(src, dest, ignore=None):
+    # The (source, destination) pairs shutil.copytree() would copy, with the
+    # destination directories created
+    pairs = []
+    for root, dirs, files in os.walk(src):
+        ignored = set(ignore(root, dirs + files)) if ignore else set()
+        dirs[:] = [d for d in dirs if d not in ignored]
+        target = os.path.normpath(os.path.join(dest, os.path.relpath(root, src)))
+        os.makedirs(target, exist_ok=True)
+        pairs += [(os.path.join(root, f), os.path.join(target, f)) for f in files if f not in ignored]
+    return pairs
+
+
+def stage_files(pairs, mode, jobs=1):
+    # Stages files from a pool of threads, with mode 'link' as reflinks or
+    # hardlinks where the filesystem allows. Returns how many bytes were
+    # copied and how many linked.
+    methods = list(staging_methods[mode])
+    with ThreadPoolExecutor(max(jobs, 1)) as pool:
+        used = list(pool.map(lambda pair: stage_file(*pair, methods), pairs))
+    totals = {'copied': 0, 'linked': 0}
+    for (src, _), method in zip(pairs, used):
+        totals['copied' if method is shutil.copy2 else 'linked'] += os.stat(src).st_size
+    return totals
+
+
+def copy_over(src, dest):
+    # Replaces dest instead of writing into it, as it may be a hardlink to a
+    # file outside the staging directory
+    shutil.copyfile(src, temp_path(dest))
+    os.replace(temp_path(dest), dest)
+
+
+def runtime_files(pcbuild, lib, overlay):
+    # The files of a staged cpython directory, mapped from where they already
+    # are instead: the PCbuild output, the modules kept out of the stdlib
+    # archive and an overlay holding only the files the build generates.
+    files = {}
+    for src, name in collect_files(pcbuild, pcbuild):
+        files[name] = src
+    for src, name in find_non_zip_modules(lib):
+        if os.path.isdir(src):
+            for path, rel in collect_files(src, lib, excludes=[]):
+                files[rel] = path
+        else:
+            files[name] = src
+    for src, name in collect_files(overlay, overlay, excludes=[]):
+        files[name] = src
+    return sorted((src, name) for name, src in files.items())
+
+
+def build_arch(args, arch, stub, jobs):
+    # Builds the runtime and exe for one arch. Everything the build changes
+    # is staged in a directory of its own under --staging, so the pipelines
+    # for several archs can run at once. The content-addressed archives in
+    # the cache are shared between them.
+    report = {'phases': [], 'archives': {}}
+    staging = os.path.join(args.staging, arch)
+    cpython = os.path.join(staging, 'cpython')
+    # With --staging-mode direct, cpython is only an overlay of generated files
+    direct = args.staging_mode == 'direct'
+    python38_zip = os.path.join(cpython, 'python38.zip')
+
+    print(f"Creating runtime archive for {arch}...")
+    start = phase_start()
+    pcbuild = os.path.join(python_loc, "PCbuild", arch)
+    lib = os.path.join(python_loc, "Lib")
+    py_exe = os.path.join(pcbuild, 'python.exe')
+    subprocess.run([py_exe, '-m', 'lib2to3'], stdout=subprocess.PIPE)
+
+    # Every stage is keyed on a hash of its inputs and skipped when an
+    # earlier build already produced output for the same key.
+    cache = {} if args.no_cache else load_cache(staging)
+
+    cpython_key = stage_key(
+        'cpython',
+        hash_tree(pcbuild, python_loc),
+        [(name, hash_tree(src) if os.path.isdir(src) else hash_file(src))
+         for src, name in find_non_zip_modules(lib)],
+        non_zip_modules,
+        zip_excludes,
+        py_deps,
+        args.bytecode and args.optimize,
+        direct,
+    )
+    stdlib_key = stage_key('stdlib', hash_tree(lib), zip_excludes)
+    bytecode_key = stage_key('bytecode', stdlib_key, args.optimize)
+    runtime_excludes = bytecode_excludes if args.bytecode else zip_excludes
+    runtime_manifest = 'feet/manifest.json'
+    runtime_key = stage_key(
+        'runtime',
+        cpython_key,
+        bytecode_key if args.bytecode else stdlib_key,
+        hash_tree('feet', '.'),
+        runtime_excludes,
+        args.compression,
+        args.compresslevel,
+        runtime_manifest,
+    )
+    phase_end(report, 'cache-keys', start, bytes_in=tree_size(pcbuild) + tree_size(lib))
+
+    start = phase_start()
+    # No interpreter is staged in direct mode, so the build runs the one in
+    # PCbuild, which has the same version
+    feet_py = py_exe if direct else os.path.join(cpython, "python.exe")
+    cpython_fresh = (cache.get('cpython') == cpython_key
+                     and os.path.exists(cpython if direct else feet_py))
+    totals = {'copied': 0, 'linked': 0}
+    if cpython_fresh:
+        print("Reusing cached", cpython)
+    else:
+        cache.pop('cpython', None)
+        cache.pop('stdlib', None)
+        save_cache(staging, cache)
+
+        if os.path.exists(cpython):
+            shutil.rmtree(cpython)
+        if direct:
+            os.makedirs(os.path.join(cpython, "lib"))
+        else:
+            pairs = tree_pairs(pcbuild, cpython, ignore=ignore_excludes)
+            os.makedirs(os.path.join(cpython, "lib"))
+
+            for src, name in find_non_zip_modules(lib):
+                print(f"Staging {src}")
+                if os.path.isdir(src):
+                    pairs += tree_pairs(src, os.path.join(cpython, name))
+                else:
+                    pairs.append((src, os.path.join(cpython, name)))
+            print(f"Staging {len(pairs)} files into {cpython} ({args.staging_mode})")
+            totals = stage_files(pairs, args.staging_mode, jobs)
+
+    staged = tree_size(cpython)
+    phase_end(report, 'stage-cpython', start, bytes_in=staged, bytes_out=totals['copied'],
+              linked=totals['linked'], cached=cpython_fresh)
+
+    # Create the stdlib zip to make unpacking faster
+    start = phase_start()
+    stdlib_zip = os.path.join(cache_dir, f"python38-{stdlib_key}.zip")
+    stdlib_cached = os.path.exists(stdlib_zip) and not args.no_cache
+    if not stdlib_cached:
+        zipdir(lib, None, temp_path(stdlib_zip), zipfile.ZIP_DEFLATED, jobs=jobs)
+        os.replace(temp_path(stdlib_zip), stdlib_zip)
+    # A bytecode archive also works for running the compiler below
+    usable = (stdlib_key, bytecode_key) if args.bytecode else (stdlib_key,)
+    if cache.get('stdlib') not in usable or not os.path.exists(python38_zip):
+        copy_over(stdlib_zip, python38_zip)
+        cache['stdlib'] = stdlib_key
+        save_cache(staging, cache)
+    totals = archive_totals(stdlib_zip)
+    phase_end(report, 'stdlib-zip', start, bytes_in=totals['uncompressed'], bytes_out=totals['size'],
+              cached=stdlib_cached)
+
+    start = phase_start()
+    if not cpython_fresh:
+        if direct:
+            # pip runs from the wheel ensurepip bundles, installing into the
+            # overlay rather than the PCbuild interpreter's own site-packages
+            wheels = sorted(glob.glob(os.path.join(lib, 'ensurepip', '_bundled', 'pip-*.whl')))
+            assert wheels, f"No pip wheel bundled with ensurepip in {lib}"
+            subprocess.check_call([
+                feet_py, os.path.join(wheels[-1], 'pip'), 'install',
+                '--target', os.path.join(cpython, 'lib', 'site-packages'), *py_deps,
+            ])
+        else:
+            subprocess.check_call([feet_py, '-m', 'ensurepip'])
+            for name in py_deps:
+                try:
+                    p = subprocess.run([feet_py, '-m', 'pip', 'install', '-U', name], text=True)
+                    print(f"Installing package '{name}'")
+                    if p.stdout:
+                        print(p.stdout)
+                except FileNotFoundError:
+                    logger.error(f"Could not find python executable to install deps: {feet_py}")
+                    raise
+        if args.bytecode:
+            # Bytecode for the modules kept outside the stdlib archive, put
+            # in the overlay when their sources are mapped from the checkout
+            sources = []
+            for src, name in runtime_files(pcbuild, lib, cpython) if direct else collect_files(cpython, cpython):
+                if name.endswith('.py') and name.split(os.sep)[0].lower() != 'lib':
+                    cfile = None
+                    if direct:
+                        pyc = os.path.basename(name)[:-3] + f'.{runtime_cache_tag}.pyc'
+                        cfile = os.path.join(cpython, os.path.dirname(name), '__pycache__', pyc)
+                    sources.append((src, cfile, name))
+            compile_bytecode(feet_py, sources, args.optimize, jobs)
+        cache['cpython'] = cpython_key
+        save_cache(staging, cache)
+    phase_end(report, 'pip', start, bytes_out=tree_size(cpython) - staged, cached=cpython_fresh)
+
+    if args.bytecode:
+        start = phase_start()
+        bytecode_zip = os.path.join(cache_dir, f"python38-{bytecode_key}.zip")
+        bytecode_cached = os.path.exists(bytecode_zip) and not args.no_cache
+        if not bytecode_cached:
+            pyc_dir = os.path.join(staging, 'pyc')
+            if os.path.exists(pyc_dir):
+                shutil.rmtree(pyc_dir)
+            if cache.get('stdlib') != stdlib_key:
+                copy_over(stdlib_zip, python38_zip)
+                cache['stdlib'] = stdlib_key
+            source_time = None if direct else import_time(feet_py)
+            compile_stdlib(feet_py, lib, temp_path(bytecode_zip), pyc_dir, args.optimize, jobs)
+            os.replace(temp_path(bytecode_zip), bytecode_zip)
+            shutil.rmtree(pyc_dir)
+            copy_over(bytecode_zip, python38_zip)
+            # Without a staged runtime there is nothing to time
+            if source_time is not None:
+                bytecode_time = import_time(feet_py)
+                print(f"Import time for a typical main.py: {source_time * 1000:.1f}ms from sources, "
+                      f"{bytecode_time * 1000:.1f}ms from bytecode (-O{args.optimize})")
+        elif cache.get('stdlib') != bytecode_key:
+            copy_over(bytecode_zip, python38_zip)
+        cache['stdlib'] = bytecode_key
+        save_cache(staging, cache)
+        totals = archive_totals(bytecode_zip)
+        phase_end(report, 'bytecode', start, bytes_in=totals['uncompressed'], bytes_out=totals['size'],
+                  cached=bytecode_cached)
+
+    # The full stdlib was needed to set up pip and compile bytecode; the
+    # runtime itself only gets what the app can reach
+    if args.prune_for:
+        start = phase_start()
+        full_zip = bytecode_zip if args.bytecode else stdlib_zip
+        traced = ()
+        if args.trace:
+            os.makedirs(os.path.join(staging, 'trace'), exist_ok=True)
+            traced = trace_imports(py_exe, args.prune_for, os.path.join(staging, 'trace'))
+        reachable = reachable_stdlib(lib, args.prune_for, args.keep, traced, os.path.join(cpython, 'lib', 'site-packages'))
+        prune_key = stage_key('prune', bytecode_key if args.bytecode else stdlib_key, sorted(reachable))
+        pruned_zip = os.path.join(cache_dir, f"python38-{prune_key}.zip")
+        pruned_cached = os.path.exists(pruned_zip) and not args.no_cache
+        if not pruned_cached:
+            filter_zip(full_zip, temp_path(pruned_zip), reachable)
+            os.replace(temp_path(pruned_zip), pruned_zip)
+        if cache.get('stdlib') != prune_key:
+            copy_over(pruned_zip, python38_zip)
+            cache['stdlib'] = prune_key
+            save_cache(staging, cache)
+        runtime_key = stage_key(runtime_key, prune_key)
+        phase_end(report, 'prune', start, bytes_in=os.stat(full_zip).st_size,
+                  bytes_out=os.stat(pruned_zip).st_size, cached=pruned_cached)
+    report['archives']['stdlib'] = archive_totals(python38_zip)
+
+    # The runtime archive is streamed straight into the exe after the
+    # bootloader, then copied out of it into the cache for later builds.
+    # A cached archive is appended with the kernel's file copy instead.
+    print("Combining...")
+    start = phase_start()
+    runtime_zip = os.path.join(cache_dir, f"feetruntime-{runtime_key}.zip")
+    runtime_cached = os.path.exists(runtime_zip) and not args.no_cache
+    output = args.output
+    if output and len(args.arch) > 1:
+        base, ext = os.path.splitext(output)
+        output = f'{base}-{arch}{ext}'
+    output = output or f'build/feet-{arch}-{version}'
+    if not output.endswith('.exe'):
+        output += '.exe'
+
+    shutil.copyfile(stub, output)
+    with open(output, 'r+b') as final:
+        final.seek(0, os.SEEK_END)
+        runner_size = final.tell()
+        if runtime_cached:
+            print("Reusing cached", runtime_zip)
+            append_file(final, runtime_zip)
+        else:
+            # feet/ from the repo, with the staged cpython as feet/cpython
+            if direct:
+                files = [
+                    (src, os.path.join('cpython', name))
+                    for src, name in runtime_files(pcbuild, lib, cpython)
+                    if not is_excluded(os.path.join('cpython', name), runtime_excludes)
+                ]
+            else:
+                files = collect_files(cpython, staging, runtime_excludes)
+            members = collect_files('feet', '.', runtime_excludes) + [
+                (src, os.path.join('feet', name)) for src, name in files
+            ]
+            print("Writing zip file", output, "from feet and", cpython)
+            write_zip(
+                OffsetFile(final, runner_size),
+                members,
+                compressions[args.compression],
+                jobs,
+                args.compresslevel,
+                runtime_manifest,
+            )
+            final.seek(0, os.SEEK_END)
+            final.flush()
+            with open(temp_path(runtime_zip), 'wb') as cached:
+                append_file(cached, output, runner_size)
+            os.replace(temp_path(runtime_zip), runtime_zip)
+        archive_size = final.tell() - runner_size
+        metadata = {
+            'feet_format': '1',
+            'feet_arch': arch,
+            'feet_runner_size': runner_size,
+            'feet_archive_size': archive_size,
+            'feet_compression': args.compression,
+            'feet_compresslevel': args.compresslevel,
+            'feet_manifest': runtime_manifest,
+            'feet_runtime_id': runtime_id(runtime_zip, runtime_manifest),
+        }
+        if args.shared_runtime:
+            metadata['feet_runtime_store'] = 'shared'
+        set_comment(final, json.dumps(metadata).encode('utf8'))
+
+    report['archives']['runtime'] = totals = archive_totals(runtime_zip)
+    phase_end(report, 'combine', start,
+              bytes_in=runner_size + (archive_size if runtime_cached else totals['uncompressed']),
+              bytes_out=os.stat(output).st_size, cached=runtime_cached)
+    report['archives']['exe'] = archive_totals(output)
+    report['output'] = output
+    return report
 
 
 def main(args):
@@ -140,115 +1019,66 @@ def main(args):
     if args.command == "python":
         if not os.path.exists(python_loc):
             assert python_loc_default == python_loc, "No python checkout found at FEET_PYTHON_DIR"
-            subprocess.check_call(f"git clone https://github.com/python/cpython.git {python_loc}")
-        os.chdir(python_loc)
-        subprocess.check_call("git fetch")
-        subprocess.check_call("git reset --hard HEAD")
-        subprocess.check_call(f"git checkout {args.pyversion}")
-        os.chdir('..')
-
-        assert os.path.exists(f"./{python_loc}/PCBuild/build.bat")
-        if args.arch == "amd64":
-            p = "x64"
-        else:
-            p = args.arch
-        print(f"./{python_loc}/PCBuild/build.bat -c Release -p {p} -t Build")
-        subprocess.check_call(f"{python_loc}\\PCBuild\\build.bat -c Release -p {p} -t Build")
+            subprocess.check_call(["git", "clone", "https://github.com/python/cpython.git", python_loc])
+        subprocess.check_call(["git", "fetch"], cwd=python_loc)
+        subprocess.check_call(["git", "reset", "--hard", "HEAD"], cwd=python_loc)
+        subprocess.check_call(["git", "checkout", args.pyversion], cwd=python_loc)
+
+        build_bat = os.path.join(python_loc, "PCbuild", "build.bat")
+        assert os.path.exists(build_bat)
+        for arch in args.arch or ['win32']:
+            if arch == "amd64":
+                p = "x64"
+            else:
+                p = arch
+            print(f"{build_bat} -c Release -p {p} -t Build")
+            subprocess.check_call([build_bat, "-c", "Release", "-p", p, "-t", "Build"])
 
     elif not args.command or args.command == "build":
-        if os.path.exists("feet/cpython"):
-            shutil.rmtree("feet/cpython")
-
-        print("Compiling bootloader...")
-        subprocess.check_call("cargo build --release")
-
-        print("Creating runtime archive...")
-        py_exe = os.path.join(python_loc, "PCbuild", args.arch, 'python.exe')
-        subprocess.run([py_exe, '-m', 'lib2to3'], stdout=subprocess.PIPE)
-        shutil.copytree(
-            os.path.join(python_loc, "PCbuild", args.arch),
-            "feet/cpython",
-            ignore=ignore_excludes,
-        )
-        
-        os.makedirs("feet/cpython/lib")
-
-        for name in os.listdir(os.path.join(python_loc, 'Lib')):
-
-            src = os.path.join(python_loc, "lib", name)
-            if os.path.splitext(name)[0] in non_zip_modules:
-                if not os.path.exists(src):
-                    name += ".py"
-                    src = os.path.join(python_loc, "lib", name)
-                if not os.path.exists(src):
-                    print("Missing", src)
-                else:
-                    print(f"Copying {src}")
-                    if os.path.isdir(src):
-                        shutil.copytree(src, f"feet/cpython/{name}")
-                    else:
-                        shutil.copy(
-                            src,
-                            "feet/cpython/",
-                        )
-        
-        feet_py = "feet/cpython/python.exe"
-
-        # Create the stdlib zip to make unpacking faster
-        zipdir(
-            os.path.join(python_loc, "lib"),
-            None,
-            os.path.join("feet", "cpython", "python38.zip"),
-            zipfile.ZIP_DEFLATED,
-        )
+        args.arch = list(dict.fromkeys(args.arch or ['win32']))
+        report = {'phases': []}
+        build_start = phase_start()
 
-        # Create the archive to attach to feet.exe to self-extract
-        
-        subprocess.check_call([feet_py, '-m', 'ensurepip'])
-        for name in py_deps:
-            try:
-                p = subprocess.run([feet_py, '-m', 'pip', 'install', '-U', name], text=True)
-                print(f"Installing package '{name}'")
-                if p.stdout:
-                    print(p.stdout)
-            except FileNotFoundError:
-                logger.error(f"Could not find python executable to install deps: {feet_py}")
-                raise
-
-        # Create archive to attach to runtime
-        zipdir(
-            './feet/',
-            '.',
-            './feetruntime.zip',
-            zipfile.ZIP_BZIP2,
-        )
-        
-        print("Combining...")
-        if not os.path.exists('build'):
-            os.mkdir('build')
-
-        base = open('target/release/feet.exe', 'rb')
-        archive = open('feetruntime.zip', 'rb')
-        output = getattr(args, 'output', None) or f'build/feet-{args.arch}-{version}'
-        if not output.endswith('.exe'):
-            output += '.exe'
-        final = open(output, 'wb')
-
-        final.write(base.read())
-        final.write(archive.read())
-
-        final.close()
-        base.close()
-        archive.close()
-
-        # add metadata
-        final = zipfile.ZipFile(output, 'a')
-        final.comment = json.dumps({
-            'feet_format': '1',
-            'feet_arch': args.arch,
-            'feet_runner_size': os.stat('target/release/feet.exe').st_size,
-            'feet_archive_size': os.stat('feetruntime.zip').st_size,
-        }).encode('utf8')
+        stub = args.stub
+        if not stub:
+            print("Compiling bootloader...")
+            start = phase_start()
+            subprocess.check_call("cargo build --release")
+            stub = 'target/release/feet.exe'
+            phase_end(report, 'bootloader', start, bytes_out=os.stat(stub).st_size)
+
+        os.makedirs('build', exist_ok=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        if len(args.arch) == 1:
+            builds = {args.arch[0]: build_arch(args, args.arch[0], stub, args.jobs)}
+        else:
+            # Every arch is staged on its own, so their pipelines run side
+            # by side in worker processes, splitting the jobs between them
+            jobs = max(1, args.jobs // len(args.arch))
+            with ProcessPoolExecutor(len(args.arch)) as pool:
+                futures = {arch: pool.submit(build_arch, args, arch, stub, jobs) for arch in args.arch}
+                builds = {arch: future.result() for arch, future in futures.items()}
+
+        if args.report:
+            wall, cpu = build_start
+            now = os.times()
+            if len(args.arch) == 1:
+                build, = builds.values()
+                report['phases'] += build['phases']
+                report['archives'] = build['archives']
+                report['arch'] = args.arch[0]
+            else:
+                report['builds'] = builds
+            report.update({
+                'feet_version': version.strip(),
+                'options': {key: value for key, value in vars(args).items() if key != 'command'},
+                'wall': time.perf_counter() - wall,
+                'cpu': sum(now[:4]) - sum(cpu[:4]),
+                'time': time.time(),
+            })
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=2)
+            print("Build report written to", args.report)
 
         print("Done.")
 
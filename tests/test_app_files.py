@@ -1,4 +1,10 @@
+import hashlib
+import io
+import json
+import os
+import subprocess
 import sys
+import zipfile
 sys.path.append('feet')
 
 from unittest.mock import patch
@@ -42,4 +48,331 @@ def test_excludes():
         include = set(feet.get_app_files(None))
         assert include == set(['main.py', 'feet.exe'])
         include = set(feet.get_app_files(None, exclude=['*.exe']))
-        assert include == set(['main.py'])
\ No newline at end of file
+        assert include == set(['main.py'])
+
+def test_feetignore(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / '.feetignore').write_text('\n'.join([
+        '# comment',
+        '*.log',
+        '!keep.log',
+        'build/',
+        '/notes.txt',
+        'assets/**/*.psd',
+    ]))
+    excluded = feet.compile_excludes(feet.zip_excludes)
+
+    assert excluded('foo.pyc')
+    assert excluded('dist', True)
+    assert excluded('debug.log')
+    assert excluded('sub/debug.log')
+    assert not excluded('keep.log')
+    assert excluded('build', True)
+    assert not excluded('build')
+    assert excluded('build/out.txt')
+    assert excluded('notes.txt')
+    assert not excluded('docs/notes.txt')
+    assert excluded('assets/art/big/sprite.psd')
+    assert not excluded('assets/art/sprite.png')
+    assert not excluded('main.py')
+
+
+def test_walk_prunes_excluded_dirs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for path in ['main.py', 'lib/mod.py', 'dist/old.zip', 'feet_data/cpython/python.exe',
+                 'lib/__pycache__/mod.cpython-38.pyc']:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text('')
+
+    visited = []
+    scandir = os.scandir
+    def recording_scandir(path='.'):
+        visited.append(os.path.normpath(path))
+        return scandir(path)
+
+    with patch('os.scandir', recording_scandir):
+        names = sorted(name for _, name in feet.walk_files('.', feet.compile_excludes(feet.zip_excludes)))
+
+    assert names == ['lib/mod.py'.replace('/', os.sep), 'main.py']
+    assert 'dist' not in visited
+    assert 'feet_data' not in visited
+
+
+def test_write_bundle(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for path in ['main.py', 'lib/mod.py', 'dist/old.zip', 'foo.pyc']:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(path)
+
+    dest = os.path.join('dist', 'app.zip')
+    with zipfile.ZipFile(dest, 'w') as zf:
+        zf.writestr('stale.py', '')
+
+    members = feet.collect_members(['main.py'], prefix='.')
+    assert [name for _, name in members] == ['main.py', 'lib/mod.py']
+
+    feet.write_bundle(dest, members, zipfile.ZIP_DEFLATED)
+    feet.write_bundle(dest, members, zipfile.ZIP_DEFLATED)
+
+    with zipfile.ZipFile(dest) as zf:
+        assert zf.namelist() == ['lib/mod.py', 'main.py']
+        assert zf.read('lib/mod.py') == b'lib/mod.py'
+    assert sorted(os.listdir('dist')) == ['app.zip', 'old.zip']
+
+
+def test_write_bundle_nested_dirs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for path in ['main.py', 'assets/levels/one.txt', 'assets/logo.png']:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(path)
+
+    members = feet.collect_members([], prefix='.')
+    assert sorted(name for _, name in members) == ['assets/levels/one.txt', 'assets/logo.png', 'main.py']
+
+    dest = str(tmp_path / 'app.zip')
+    feet.write_bundle(dest, members, zipfile.ZIP_DEFLATED, manifest='feet/app_manifest.json')
+
+    with zipfile.ZipFile(dest) as zf:
+        assert zf.read('assets/levels/one.txt') == b'assets/levels/one.txt'
+        assert sorted(json.loads(zf.read('feet/app_manifest.json'))['files']) == [
+            'assets/levels/one.txt', 'assets/logo.png', 'main.py']
+
+
+def test_write_bundle_manifest(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'main.py').write_text('print("hi")')
+    base = str(tmp_path / 'feet.exe')
+    with open(base, 'wb') as f:
+        f.write(b'stub')
+    with zipfile.ZipFile(base, 'a') as zf:
+        zf.writestr('feet/feet.py', '')
+        zf.comment = b'{"feet_format": "1"}'
+
+    dest = str(tmp_path / 'app.exe')
+    feet.write_bundle(dest, [('main.py', 'main.py')], zipfile.ZIP_DEFLATED, base=base, manifest='feet/app_manifest.json')
+
+    with zipfile.ZipFile(dest) as zf:
+        assert json.loads(zf.comment) == {'feet_format': '1', 'feet_app_manifest': 'feet/app_manifest.json'}
+        assert json.loads(zf.read('feet/app_manifest.json')) == {'files': {
+            'main.py': [11, hashlib.sha256(b'print("hi")').hexdigest()],
+        }}
+
+
+@pytest.mark.parametrize('mode', ['alongside', 'replace'])
+def test_compile_members(tmp_path, monkeypatch, mode):
+    import importlib.util
+
+    monkeypatch.chdir(tmp_path)
+    for path, content in [('main.py', 'import lib.mod'), ('lib/mod.py', 'value = 1'),
+                          ('lib/broken.py', 'def ('), ('lib/data.txt', '')]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(content)
+    workdir = tmp_path / 'work'
+
+    members = feet.collect_members(['main.py'], prefix='.')
+    members = feet.compile_members(str(workdir), members, mode, keep=['main.py'])
+
+    pyc = importlib.util.cache_from_source('lib/mod.py') if mode == 'alongside' else 'lib/mod.pyc'
+    expected = {'main.py', 'lib/broken.py', 'lib/data.txt', pyc}
+    if mode == 'alongside':
+        expected.add('lib/mod.py')
+    names = {name for _, name in members}
+    assert names == expected
+    src = dict((name, src) for src, name in members)[pyc]
+    with open(src, 'rb') as f:
+        header = f.read(16)
+    # An unchecked hash pyc
+    assert header[:4] == importlib.util.MAGIC_NUMBER
+    assert int.from_bytes(header[4:8], 'little') == 0b01
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2])
+def test_write_bundle_incremental(tmp_path, monkeypatch, compression):
+    monkeypatch.chdir(tmp_path)
+    for i in range(5):
+        (tmp_path / f'asset{i}.txt').write_text(f'asset {i}\n' * 1000)
+    (tmp_path / 'feet.exe').write_bytes(b'stub' * 100)
+    members = [(f'asset{i}.txt', f'assets/{i}.txt') for i in range(5)]
+    dest = str(tmp_path / 'app.exe')
+
+    feet.write_bundle(dest, members, compression, base='feet.exe', manifest='feet/app_manifest.json')
+    first = open(dest, 'rb').read()
+
+    (tmp_path / 'asset3.txt').write_text('changed')
+    with patch('feet.write_member', side_effect=feet.write_member) as write:
+        feet.write_bundle(dest, members, compression, base='feet.exe', manifest='feet/app_manifest.json')
+    assert [call[0][1] for call in write.call_args_list] == ['asset3.txt']
+
+    with zipfile.ZipFile(dest) as zf:
+        assert zf.testzip() is None
+        assert zf.read('assets/3.txt') == b'changed'
+        assert zf.read('assets/4.txt') == b'asset 4\n' * 1000
+        manifest = json.loads(zf.read('feet/app_manifest.json'))['files']
+        assert manifest['assets/3.txt'] == [7, hashlib.sha256(b'changed').hexdigest()]
+
+    # Everything before the changed member is byte for byte the same
+    changed = zipfile.ZipFile(io.BytesIO(first)).getinfo('assets/3.txt').header_offset
+    assert open(dest, 'rb').read()[:changed] == first[:changed]
+
+
+def make_release(tmp_path, dest, assets):
+    for name, content in assets.items():
+        path = tmp_path / 'src' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    members = [(str(tmp_path / 'src' / name), name) for name in reversed(list(assets))]
+    feet.write_bundle(str(dest), members, zipfile.ZIP_DEFLATED, base=str(tmp_path / 'feet.exe'))
+
+
+def test_write_bundle_reproducible(tmp_path):
+    (tmp_path / 'feet.exe').write_bytes(b'stub')
+    assets = {'main.py': b'print(1)', 'data/a.bin': os.urandom(1000)}
+    make_release(tmp_path, tmp_path / 'one.exe', assets)
+    os.utime(str(tmp_path / 'src' / 'main.py'), (1e9, 1e9))
+    make_release(tmp_path, tmp_path / 'two.exe', dict(reversed(list(assets.items()))))
+    assert (tmp_path / 'one.exe').read_bytes() == (tmp_path / 'two.exe').read_bytes()
+
+
+def test_patch_apply(tmp_path):
+    (tmp_path / 'feet.exe').write_bytes(os.urandom(50000))
+    assets = {f'assets/{i}.bin': os.urandom(20000) for i in range(20)}
+    assets['main.py'] = b'print("v1")'
+    make_release(tmp_path, tmp_path / 'v1.exe', assets)
+    assets['main.py'] = b'print("v2")'
+    assets['assets/new.bin'] = b'new'
+    del assets['assets/3.bin']
+    make_release(tmp_path, tmp_path / 'v2.exe', assets)
+
+    patch_file = str(tmp_path / 'v2.feetpatch')
+    assert feet.make_patch(str(tmp_path / 'v1.exe'), str(tmp_path / 'v2.exe'), patch_file) == 0
+    assert os.path.getsize(patch_file) < 2000
+
+    installed = tmp_path / 'app.exe'
+    installed.write_bytes((tmp_path / 'v1.exe').read_bytes())
+    assert feet.apply_patch(patch_file, str(installed), str(installed)) == 0
+    assert installed.read_bytes() == (tmp_path / 'v2.exe').read_bytes()
+
+    # Only the exact version the patch was made from is accepted
+    assert feet.apply_patch(patch_file, str(installed), str(installed)) == 1
+    assert installed.read_bytes() == (tmp_path / 'v2.exe').read_bytes()
+    assert not os.path.exists(str(installed) + '.tmp')
+
+
+def test_parse_requirement():
+    assert feet.parse_requirement('PyGame==1.9.6\n') == ('pygame', 'PyGame==1.9.6')
+    assert feet.parse_requirement('zope.interface >= 5 # pinned\n') == ('zope-interface', 'zope.interface >= 5')
+    assert feet.parse_requirement('requests[socks]; python_version > "3"') == ('requests', 'requests[socks]; python_version > "3"')
+    assert feet.parse_requirement('--index-url https://example.com/') == (None, '--index-url https://example.com/')
+    assert feet.parse_requirement('https://example.com/a.whl') == (None, 'https://example.com/a.whl')
+    assert feet.parse_requirement('# just a comment') is None
+    assert feet.parse_requirement('   \n') is None
+
+
+@pytest.fixture
+def site_packages(tmp_path, monkeypatch):
+    path = tmp_path / 'site-packages'
+    for dist in ['PyGame-1.9.6.dist-info', 'zope.interface-5.0-py3.8.egg-info', 'pip-23.0.dist-info']:
+        (path / dist).mkdir(parents=True)
+    monkeypatch.setattr(feet, 'site_packages', str(path))
+    monkeypatch.setattr(feet, 'requirements_state', str(tmp_path / 'requirements_state.txt'))
+    monkeypatch.chdir(tmp_path)
+    return path
+
+
+def test_unsatisfied_requirements(site_packages):
+    lines = [
+        'pygame==1.9.6',
+        'zope_interface>=4',
+        'pip<20',
+        'requests',
+        'colorama; sys_platform == "never"',
+    ]
+    requirements = [feet.parse_requirement(line) for line in lines]
+    assert feet.unsatisfied_requirements(requirements) == ['pip<20', 'requests']
+
+    requirements.append(feet.parse_requirement('-e ./local'))
+    assert feet.unsatisfied_requirements(requirements) is None
+
+
+def test_update_libraries(site_packages):
+    with open('requirements.txt', 'w') as f:
+        f.write('pygame==1.9.6\nrequests\n')
+    assert feet.requirements_changed()
+
+    with patch('subprocess.check_call') as check_call:
+        feet.update_libraries('python')
+        assert check_call.call_args[0][0][-1:] == ['requests']
+        assert not feet.requirements_changed()
+
+        check_call.reset_mock()
+        os.utime('requirements.txt', ns=(0, 0))
+        assert feet.requirements_changed()
+        feet.update_libraries('python')
+        assert not check_call.called
+        assert not feet.requirements_changed()
+
+
+def test_build_wheelhouse(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('FEET_WHEEL_CACHE', str(tmp_path / 'cache'))
+    os.mkdir('cache')
+    with open('requirements.txt', 'w') as f:
+        f.write('pysdl2\n')
+
+    def pip_wheel(cmd):
+        wheelhouse = cmd[cmd.index('-w') + 1]
+        os.makedirs(wheelhouse)
+        for wheel in ['PySDL2-0.9.7-py3-none-any.whl', 'pysdl2_dll-2.0.12-py2.py3-none-win32.whl']:
+            open(os.path.join(wheelhouse, wheel), 'w').close()
+
+    with patch('subprocess.check_call', pip_wheel):
+        members = feet.build_wheelhouse('python', str(tmp_path / 'work'))
+
+    assert [name for _, name in members] == [
+        'requirements.lock',
+        'wheelhouse/PySDL2-0.9.7-py3-none-any.whl',
+        'wheelhouse/pysdl2_dll-2.0.12-py2.py3-none-win32.whl',
+    ]
+    assert open(members[0][0]).read() == 'PySDL2==0.9.7\npysdl2_dll==2.0.12\n'
+    assert len(os.listdir('cache')) == 2
+
+
+def test_update_libraries_from_wheelhouse(site_packages):
+    os.mkdir('wheelhouse')
+    with open('requirements.txt', 'w') as f:
+        f.write('pygame\nrequests\n')
+    with open('requirements.lock', 'w') as f:
+        f.write('pygame==1.9.6\nrequests==2.24.0\n')
+
+    assert feet.requirements_file() == 'requirements.lock'
+    with patch('subprocess.check_call') as check_call:
+        feet.update_libraries('python')
+    assert check_call.call_args[0][0] == [
+        'python', '-m', 'pip', 'install', '--trusted-host=pypi.org',
+        '--no-index', '--no-deps', '--find-links', 'wheelhouse', 'requests==2.24.0',
+    ]
+    assert not feet.requirements_changed(feet.requirements_file())
+
+
+def test_add_libraries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv('FEET_WHEEL_CACHE', raising=False)
+    with open('requirements.txt', 'w') as f:
+        f.write('pygame==1.9.6\nrequests\n')
+    with open('more.txt', 'w') as f:
+        f.write('# extras\nnumpy>=1.18\n')
+
+    with patch('subprocess.check_call') as check_call:
+        feet.add_libraries('python', ['PyGame==2.0.0', 'pysdl2'], ['more.txt'])
+    check_call.assert_called_once_with([
+        'python', '-m', 'pip', 'install', '--trusted-host=pypi.org',
+        'PyGame==2.0.0', 'pysdl2', '-r', 'more.txt',
+    ])
+    assert open('requirements.txt').read() == 'PyGame==2.0.0\nrequests\npysdl2\nnumpy>=1.18\n'
+
+    failure = subprocess.CalledProcessError(1, 'pip')
+    with patch('subprocess.check_call', side_effect=failure):
+        with pytest.raises(subprocess.CalledProcessError):
+            feet.add_libraries('python', ['broken'])
+    assert open('requirements.txt').read() == 'PyGame==2.0.0\nrequests\npysdl2\nnumpy>=1.18\n'
+    assert sorted(os.listdir('.')) == ['more.txt', 'requirements.txt']
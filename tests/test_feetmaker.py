@@ -0,0 +1,393 @@
+import io
+import os
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+import feetmaker
+
+
+@pytest.fixture
+def tree(tmp_path):
+    src = tmp_path / 'src'
+    for i in range(40):
+        pkg = src / f'pkg{i % 5}'
+        pkg.mkdir(parents=True, exist_ok=True)
+        (pkg / f'mod{i}.py').write_text(f'value = {i!r}\n' * (i * 50))
+    (src / 'pkg0' / '__pycache__').mkdir()
+    (src / 'pkg0' / '__pycache__' / 'mod0.pyc').write_bytes(b'junk')
+    return src
+
+
+@pytest.mark.parametrize('compression', [
+    zipfile.ZIP_STORED,
+    zipfile.ZIP_DEFLATED,
+    zipfile.ZIP_BZIP2,
+    zipfile.ZIP_LZMA,
+])
+def test_zipdir_jobs_identical(tree, tmp_path, compression):
+    outputs = []
+    for jobs in (1, 3, 8):
+        dest = str(tmp_path / f'out{jobs}.zip')
+        feetmaker.zipdir(str(tree), None, dest, compression, jobs=jobs)
+        outputs.append(open(dest, 'rb').read())
+
+    assert outputs[0] == outputs[1] == outputs[2]
+
+    with zipfile.ZipFile(str(tmp_path / 'out1.zip')) as zf:
+        assert zf.testzip() is None
+        names = zf.namelist()
+        assert names == sorted(names)
+        assert len(names) == 40
+        assert zf.read('pkg3/mod8.py') == (tree / 'pkg3' / 'mod8.py').read_bytes()
+
+
+@pytest.mark.parametrize('codec', sorted(feetmaker.compressions))
+def test_zipdir_compresslevel(tree, tmp_path, codec):
+    compression = feetmaker.compressions[codec]
+    sizes = []
+    for level in (0, 1, 9):
+        dest = str(tmp_path / f'out{level}.zip')
+        feetmaker.zipdir(str(tree), None, dest, compression, jobs=2, compresslevel=level)
+        with zipfile.ZipFile(dest) as zf:
+            assert zf.testzip() is None
+            assert {info.compress_type for info in zf.infolist()} == {compression}
+        sizes.append(os.stat(dest).st_size)
+
+    if codec == 'deflate':
+        assert sizes[0] > sizes[1] > sizes[2]
+    elif codec == 'stored':
+        assert sizes[0] == sizes[1] == sizes[2]
+
+    args = feetmaker.parser.parse_args(['build', '--compression', codec, '--compresslevel', '1'])
+    assert (args.compression, args.compresslevel) == (codec, 1)
+
+
+def test_zipdir_reproducible(tree, tmp_path):
+    first = str(tmp_path / 'first.zip')
+    feetmaker.zipdir(str(tree), None, first, zipfile.ZIP_DEFLATED, manifest='manifest.json')
+
+    for i, path in enumerate(sorted(tree.rglob('*.py'))):
+        os.utime(str(path), (1e9 + i, 1e9 + i))
+    os.chmod(str(tree / 'pkg1' / 'mod1.py'), 0o600)
+    os.chmod(str(tree / 'pkg2' / 'mod2.py'), 0o700)
+    second = str(tmp_path / 'second.zip')
+    feetmaker.zipdir(str(tree), None, second, zipfile.ZIP_DEFLATED, manifest='manifest.json')
+
+    with zipfile.ZipFile(second) as zf:
+        assert {info.date_time for info in zf.infolist()} == {(1980, 1, 1, 0, 0, 0)}
+        assert zf.getinfo('pkg1/mod1.py').external_attr >> 16 == 0o100644
+        assert zf.getinfo('pkg2/mod2.py').external_attr >> 16 == 0o100755
+    os.chmod(str(tree / 'pkg2' / 'mod2.py'), 0o644)
+    feetmaker.zipdir(str(tree), None, second, zipfile.ZIP_DEFLATED, manifest='manifest.json')
+    assert open(first, 'rb').read() == open(second, 'rb').read()
+
+
+def test_runtime_id(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'feet' / 'cpython').mkdir(parents=True)
+    (src / 'feet' / 'cpython' / 'python.exe').write_text('python')
+    (src / 'feet' / 'feet.py').write_text('v1')
+
+    def runtime_id(name):
+        archive = str(tmp_path / name)
+        feetmaker.zipdir(str(src / 'feet'), str(src), archive, zipfile.ZIP_DEFLATED, manifest='feet/manifest.json')
+        return feetmaker.runtime_id(archive, 'feet/manifest.json')
+
+    first = runtime_id('first.zip')
+    assert len(first) == 32
+    # Only the cpython directory identifies a runtime
+    (src / 'feet' / 'feet.py').write_text('v2')
+    assert runtime_id('second.zip') == first
+    (src / 'feet' / 'cpython' / 'python.exe').write_text('python2')
+    assert runtime_id('third.zip') != first
+
+
+def test_hash_tree(tree):
+    before = feetmaker.hash_tree(str(tree))
+    assert feetmaker.hash_tree(str(tree)) == before
+
+    # Excluded files don't affect the key
+    (tree / 'pkg0' / '__pycache__' / 'mod0.pyc').write_bytes(b'other junk')
+    assert feetmaker.hash_tree(str(tree)) == before
+
+    (tree / 'pkg1' / 'mod1.py').write_text('changed')
+    assert feetmaker.hash_tree(str(tree)) != before
+
+
+def test_hash_tree_skip(tree):
+    before = feetmaker.hash_tree(str(tree), skip=[str(tree / 'pkg2')])
+    (tree / 'pkg2' / 'mod2.py').write_text('changed')
+    assert feetmaker.hash_tree(str(tree), skip=[str(tree / 'pkg2')]) == before
+
+
+def test_is_excluded_matches_fnmatch():
+    import fnmatch
+    names = [
+        'os.py',
+        'json/__pycache__',
+        'json/__pycache__/decoder.cpython-38.pyc',
+        'test/test_os.py',
+        'PCbuild/win32/_testcapi.pyd',
+        'PCbuild/win32/python.pdb',
+        'PCbuild/win32/pythonw.exe',
+        'unittest/case.py',
+    ]
+    for name in names:
+        expected = any(fnmatch.fnmatch(name, p) for p in feetmaker.zip_excludes)
+        assert feetmaker.is_excluded(name) == expected, name
+    assert not feetmaker.is_excluded('anything', patterns=[])
+
+
+def test_compile_stdlib(tmp_path, monkeypatch):
+    import importlib
+
+    lib = tmp_path / 'Lib'
+    lib.mkdir()
+    (lib / 'docmod.py').write_text('"""Module docs."""\nvalue = __doc__\n')
+    (lib / 'broken.py').write_text('def (:\n')
+    (lib / 'test_skipped.py').write_text('')
+    dest = str(tmp_path / 'stdlib.zip')
+
+    feetmaker.compile_stdlib(sys.executable, str(lib), dest, str(tmp_path / 'pyc'), 2, jobs=2)
+
+    with zipfile.ZipFile(dest) as zf:
+        assert zf.namelist() == ['broken.py', 'docmod.py', 'docmod.pyc']
+        flags = int.from_bytes(zf.read('docmod.pyc')[4:8], 'little')
+        assert flags == 0b01  # hash-based, source never checked
+
+    # Bytecode is preferred over the source, and -OO stripped the docstring
+    monkeypatch.syspath_prepend(dest)
+    monkeypatch.delitem(sys.modules, 'docmod', raising=False)
+    module = importlib.import_module('docmod')
+    assert module.__file__.endswith('docmod.pyc')
+    assert module.value is None
+    del sys.modules['docmod']
+
+
+@pytest.fixture
+def stdlib(tmp_path):
+    lib = tmp_path / 'Lib'
+    files = {
+        'used.py': 'import helper',
+        'helper.py': '',
+        'unused.py': 'import helper',
+        'plugins/__init__.py': '',
+        'plugins/extra.py': 'import unused',
+        'plugins/data/table.txt': 'data',
+        'plugins/tests/__init__.py': '',
+        'plugins/tests/test_extra.py': '',
+    }
+    for name, content in files.items():
+        (lib / name).parent.mkdir(parents=True, exist_ok=True)
+        (lib / name).write_text(content)
+    return lib
+
+
+def test_prune_stdlib(stdlib, tmp_path):
+    main = tmp_path / 'app' / 'main.py'
+    main.parent.mkdir()
+    main.write_text('import used\nimport importlib\nimportlib.import_module("plugins.extra")\n')
+
+    assert feetmaker.reachable_stdlib(str(stdlib), str(main)) == {'used.py', 'helper.py'}
+    reachable = feetmaker.reachable_stdlib(str(stdlib), str(main), keep=['plugins'])
+    assert reachable == {
+        'used.py', 'helper.py', 'unused.py',
+        'plugins/__init__.py', 'plugins/extra.py', 'plugins/data/table.txt',
+    }
+
+    full = str(tmp_path / 'full.zip')
+    pruned = str(tmp_path / 'pruned.zip')
+    feetmaker.zipdir(str(stdlib), None, full, zipfile.ZIP_DEFLATED)
+    with zipfile.ZipFile(full, 'a') as zf:
+        zf.writestr('used.pyc', b'bytecode')
+    feetmaker.filter_zip(full, pruned, reachable)
+    with zipfile.ZipFile(pruned) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(reachable | {'used.pyc'})
+        assert zf.read('plugins/data/table.txt') == b'data'
+
+
+def test_prune_stdlib_keeps_runtime_imports(tmp_path):
+    import sysconfig
+
+    main = tmp_path / 'main.py'
+    main.write_text('print("hi")\n')
+    site_packages = tmp_path / 'site-packages'
+    (site_packages / 'pip' / '_internal').mkdir(parents=True)
+    (site_packages / 'pip' / '__init__.py').write_text('')
+    (site_packages / 'pip' / '_internal' / '__init__.py').write_text('import csv\n')
+    lib = sysconfig.get_paths()['stdlib']
+
+    reachable = feetmaker.reachable_stdlib(lib, str(main), site_packages=str(site_packages))
+    # feet.py needs json for sync, verify and zipimport runs, and pstats for --profile
+    assert {'json/__init__.py', 'json/decoder.py', 'pstats.py', 'zipfile.py'} <= reachable
+    assert 'csv.py' in reachable
+
+
+def test_prune_stdlib_trace(tmp_path):
+    import sysconfig
+
+    main = tmp_path / 'main.py'
+    main.write_text('import importlib\nimportlib.import_module("wave")\n')
+    lib = sysconfig.get_paths()['stdlib']
+
+    assert 'wave.py' not in feetmaker.reachable_stdlib(lib, str(main))
+    traced = feetmaker.trace_imports(sys.executable, str(main), str(tmp_path))
+    reachable = feetmaker.reachable_stdlib(lib, str(main), traced=traced)
+    assert {'wave.py', 'importlib/__init__.py'} <= reachable
+
+
+def test_build_report(tree, tmp_path):
+    report = {'phases': []}
+    start = feetmaker.phase_start()
+    subprocess.check_call([sys.executable, '-c', 'sum(range(3000000))'])
+    dest = str(tmp_path / 'out.zip')
+    feetmaker.zipdir(str(tree), None, dest, zipfile.ZIP_DEFLATED)
+    totals = feetmaker.archive_totals(dest)
+    feetmaker.phase_end(report, 'zip', start, bytes_in=totals['uncompressed'], bytes_out=totals['size'], cached=False)
+
+    phase, = report['phases']
+    assert phase['name'] == 'zip'
+    assert phase['wall'] > 0
+    if sys.platform != 'win32':
+        # Includes the child interpreter's time
+        assert phase['cpu'] >= 0.01
+    assert phase['cached'] is False
+    assert totals['members'] == 40
+    assert totals['uncompressed'] == feetmaker.tree_size(str(tree)) - len(b'junk')
+    assert totals['compressed'] < totals['uncompressed'] == phase['bytes_in']
+    assert totals['size'] == os.stat(dest).st_size == phase['bytes_out']
+
+
+@pytest.mark.parametrize('kernel_copy', [True, False])
+def test_stream_archive_after_stub(tree, tmp_path, monkeypatch, kernel_copy):
+    if not kernel_copy:
+        monkeypatch.delattr(os, 'copy_file_range', raising=False)
+        monkeypatch.delattr(os, 'sendfile', raising=False)
+    standalone = str(tmp_path / 'runtime.zip')
+    feetmaker.zipdir(str(tree), None, standalone, zipfile.ZIP_BZIP2, manifest='manifest.json')
+
+    stub = os.urandom(3000)
+    output = str(tmp_path / 'feet.exe')
+    with open(output, 'wb') as final:
+        final.write(stub)
+        feetmaker.zipdir(str(tree), None, feetmaker.OffsetFile(final, len(stub)), zipfile.ZIP_BZIP2,
+                         manifest='manifest.json')
+    data = open(output, 'rb').read()
+    assert data[:len(stub)] == stub
+    assert data[len(stub):] == open(standalone, 'rb').read()
+
+    copied = str(tmp_path / 'copied.zip')
+    with open(copied, 'wb') as f:
+        feetmaker.append_file(f, output, len(stub))
+    assert open(copied, 'rb').read() == open(standalone, 'rb').read()
+
+    appended = str(tmp_path / 'appended.exe')
+    with open(appended, 'wb') as f:
+        f.write(stub)
+        feetmaker.append_file(f, standalone)
+    assert open(appended, 'rb').read() == data
+
+    with open(appended, 'r+b') as f:
+        feetmaker.set_comment(f, b'{"feet_format": "1"}')
+    with zipfile.ZipFile(appended) as zf:
+        assert zf.testzip() is None
+        assert zf.comment == b'{"feet_format": "1"}'
+
+
+@pytest.fixture
+def checkout(tmp_path, monkeypatch):
+    if sys.platform == 'win32':
+        pytest.skip('uses a shell script for the interpreter')
+
+    # A checkout with both archs built, where "python.exe" accepts anything
+    python_dir = tmp_path / 'cpython'
+    for arch in ('win32', 'amd64'):
+        pcbuild = python_dir / 'PCbuild' / arch
+        pcbuild.mkdir(parents=True)
+        (pcbuild / 'python.exe').write_text('#!/bin/sh\nexit 0\n')
+        (pcbuild / 'python.exe').chmod(0o755)
+        (pcbuild / 'python38.dll').write_text(arch)
+    for name in ('os.py', 'encodings/__init__.py', 'encodings/utf_8.py', 'json/__init__.py',
+                 'json/decoder.py', 'ensurepip/_bundled/pip-20.0.2-py2.py3-none-any.whl'):
+        (python_dir / 'Lib' / name).parent.mkdir(parents=True, exist_ok=True)
+        (python_dir / 'Lib' / name).write_text(f'# {name}\n')
+    monkeypatch.setenv('FEET_PYTHON_DIR', str(python_dir))
+    monkeypatch.setattr(feetmaker, 'python_loc', str(python_dir))
+
+    repo = tmp_path / 'repo'
+    (repo / 'feet').mkdir(parents=True)
+    (repo / 'feetmaker.py').write_text('')
+    (repo / 'feet' / 'feet.py').write_text('# feet.py\n')
+    (repo / 'stub.exe').write_bytes(b'stub' * 100)
+    monkeypatch.chdir(repo)
+    return python_dir
+
+
+def test_build_archs_in_parallel(checkout):
+    import json
+
+    repo = checkout.parent / 'repo'
+
+    def build():
+        argv = ['build', '-a', 'win32', '-a', 'amd64', '--stub', 'stub.exe', '-o', 'build/feet.exe',
+                '--compression', 'deflate', '--report', 'report.json']
+        feetmaker.main(feetmaker.parser.parse_args(argv))
+        with open('report.json') as f:
+            return json.load(f)
+
+    report = build()
+    assert sorted(report['builds']) == ['amd64', 'win32']
+    for arch in ('win32', 'amd64'):
+        output = f'build/feet-{arch}.exe'
+        assert report['builds'][arch]['output'] == output
+        assert open(output, 'rb').read(400) == b'stub' * 100
+        with zipfile.ZipFile(output) as zf:
+            assert zf.testzip() is None
+            assert json.loads(zf.comment)['feet_arch'] == arch
+            assert zf.read('feet/cpython/python38.dll') == arch.encode()
+            assert zf.read('feet/feet.py') == b'# feet.py\n'
+            assert 'feet/cpython/os.py' in zf.namelist()
+            with zf.open('feet/cpython/python38.zip') as stdlib, zipfile.ZipFile(stdlib) as lib:
+                assert 'json/decoder.py' in lib.namelist()
+        assert (repo / 'build' / 'staging' / arch / 'cpython' / 'python.exe').exists()
+    assert not (repo / 'feet' / 'cpython').exists()
+
+    first = {arch: open(f'build/feet-{arch}.exe', 'rb').read() for arch in ('win32', 'amd64')}
+    report = build()
+    for arch in ('win32', 'amd64'):
+        assert all(phase['cached'] for phase in report['builds'][arch]['phases'] if 'cached' in phase)
+        assert open(f'build/feet-{arch}.exe', 'rb').read() == first[arch]
+
+
+def test_build_staging_modes(checkout):
+    import json
+
+    def build(mode):
+        argv = ['build', '--stub', 'stub.exe', '-o', f'build/feet-{mode}.exe', '--compression', 'deflate',
+                '--staging-mode', mode, '--staging', f'build/{mode}', '--no-cache', '--report', 'report.json']
+        feetmaker.main(feetmaker.parser.parse_args(argv))
+        with open('report.json') as f:
+            report = json.load(f)
+        phase, = [phase for phase in report['phases'] if phase['name'] == 'stage-cpython']
+        return open(f'build/feet-{mode}.exe', 'rb').read(), phase
+
+    copied, phase = build('copy')
+    assert phase['bytes_out'] > 0 and phase['linked'] == 0
+    with zipfile.ZipFile(io.BytesIO(copied)) as zf:
+        assert {'feet/cpython/os.py', 'feet/cpython/encodings/utf_8.py', 'feet/cpython/python38.dll'} < set(zf.namelist())
+
+    # Every mode produces the same exe, staging nothing by copying
+    linked, phase = build('link')
+    assert linked == copied
+    assert phase['bytes_out'] == 0 and phase['linked'] == phase['bytes_in']
+    staged = 'build/link/win32/cpython/encodings/utf_8.py'
+    assert open(staged).read() == '# encodings/utf_8.py\n'
+
+    direct, phase = build('direct')
+    assert direct == copied
+    assert phase['bytes_out'] == phase['linked'] == 0
+    assert sorted(os.listdir('build/direct/win32/cpython')) == ['lib', 'python38.zip']
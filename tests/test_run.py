@@ -0,0 +1,424 @@
+import os
+import shutil
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+import feetmaker
+
+
+FEET_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'feet', 'feet.py')
+
+
+@pytest.fixture
+def app(tmp_path):
+    # An extracted Feet app, with the current interpreter standing in for
+    # the runtime's python.exe
+    data = tmp_path / 'feet_data'
+    (data / 'cpython').mkdir(parents=True)
+    shutil.copy(FEET_PY, str(data))
+    os.symlink(sys.executable, str(data / 'cpython' / 'python.exe'))
+    (tmp_path / 'feet.exe').write_bytes(b'')
+    return tmp_path
+
+
+def feet(app, *args, env=None):
+    data = app / 'feet_data'
+    return subprocess.run(
+        [str(data / 'cpython' / 'python.exe'), str(data / 'feet.py'), *args],
+        cwd=str(app),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=env,
+    )
+
+
+MAIN_ENVIRONMENT = '''
+import os, sys
+import helper
+print(__name__)
+print(os.getcwd())
+print(sys.path[0])
+print(sys.argv[0])
+print(helper.value)
+sys.exit(3)
+'''
+
+
+@pytest.mark.parametrize('flags', [[], ['--in-process']])
+def test_run_environment(app, flags):
+    (app / 'main.py').write_text(MAIN_ENVIRONMENT)
+    (app / 'helper.py').write_text('value = "helper"')
+
+    p = feet(app, 'run', *flags)
+
+    assert p.returncode == 3, p.stderr
+    name, cwd, path0, argv0, helper = p.stdout.splitlines()
+    assert name == '__main__'
+    assert cwd == str(app)
+    assert path0 == str(app)
+    assert argv0 == str(app / 'main.py')
+    assert helper == 'helper'
+
+
+def test_run_in_process_env(app):
+    (app / 'main.py').write_text('raise ValueError("boom")')
+    env = dict(os.environ, FEET_IN_PROCESS='1')
+
+    p = feet(app, env=env)
+
+    assert p.returncode == 1
+    assert 'ValueError: boom' in p.stderr
+
+
+def test_run_library_install_fails(app):
+    (app / 'main.py').write_text('print("ran")')
+    (app / 'requirements.txt').write_text('feet-no-such-package==1.0\n')
+    env = dict(os.environ, PIP_NO_INDEX='1')
+
+    for _ in range(2):
+        p = feet(app, env=env)
+        assert p.returncode == 0, p.stderr
+        assert p.stdout.splitlines()[-1] == 'ran'
+        assert 'Warning: installing libraries failed' in p.stderr
+    assert not (app / 'feet_data' / 'requirements_state.txt').exists()
+
+
+def test_library_blank_spec(app):
+    (app / 'main.py').write_text('')
+    (app / 'requirements.txt').write_text('six\n')
+
+    p = feet(app, 'library', '', '# just a comment')
+
+    assert p.returncode == 1, p.stderr
+    assert 'Name the libraries to install' in p.stdout
+    assert (app / 'requirements.txt').read_text() == 'six\n'
+
+
+# Modules the run path may import beyond what `import subprocess` already
+# costs. Anything heavier belongs in the commands that need it.
+RUN_IMPORT_BUDGET = set()
+
+
+def imported_modules(args, cwd):
+    p = subprocess.run(
+        [sys.executable, '-X', 'importtime', *args],
+        cwd=str(cwd),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert p.returncode == 0, p.stderr
+    return {
+        line.rsplit('|', 1)[1].strip()
+        for line in p.stderr.splitlines()
+        if line.startswith('import time:') and not line.endswith('imported package')
+    }
+
+
+def test_run_import_budget(app):
+    (app / 'main.py').write_text('')
+
+    baseline = imported_modules(['-c', 'import os, subprocess, sys'], app)
+    run = imported_modules([str(app / 'feet_data' / 'feet.py'), 'run'], app)
+
+    assert run - baseline <= RUN_IMPORT_BUDGET
+
+
+MAIN_PROFILED = '''
+import sys
+import json
+
+def work(n):
+    return sum(i * i for i in range(n))
+
+def main():
+    for _ in range(20):
+        work(20000)
+    print("done")
+    sys.stderr.write("app error output\\n")
+    sys.exit(4)
+
+main()
+'''
+
+
+def test_run_profile_imports(app):
+    (app / 'main.py').write_text(MAIN_PROFILED)
+
+    p = feet(app, 'run', '--profile-imports')
+
+    assert p.returncode == 4, p.stderr
+    assert p.stderr == 'app error output\n'
+    lines = p.stdout.splitlines()
+    assert lines[0] == 'done'
+    assert lines[1].split() == ['cumulative', 'self', 'module']
+    modules = [line.split()[-1] for line in lines[2:-1]]
+    assert 'json' in modules
+    cumulative = [float(line.split()[0][:-2]) for line in lines[2:-1]]
+    assert cumulative == sorted(cumulative, reverse=True)
+    assert lines[-1].endswith('ms') and 'modules imported' in lines[-1]
+
+
+def test_run_profile(app):
+    (app / 'main.py').write_text(MAIN_PROFILED)
+
+    p = feet(app, 'run', '--profile', 'out/app.pstats')
+    assert p.returncode == 4, p.stderr
+    assert (app / 'out' / 'app.pstats').exists()
+    stacks = (app / 'out' / 'app.collapsed').read_text().splitlines()
+    work = [line for line in stacks if line.rsplit(' ', 1)[0].split(';')[-1].startswith('<genexpr> (main.py:')]
+    assert work
+    assert all(';main (main.py:8);work (main.py:5);' in line for line in work)
+    assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in stacks)
+
+
+def make_exe(path, files):
+    src = path.parent / 'src'
+    shutil.rmtree(str(src), ignore_errors=True)
+    for name, content in files.items():
+        (src / name).parent.mkdir(parents=True, exist_ok=True)
+        (src / name).write_text(content)
+    feetmaker.zipdir(str(src / 'feet'), str(src), str(path), zipfile.ZIP_DEFLATED, manifest='feet/manifest.json')
+    with zipfile.ZipFile(str(path), 'a') as zf:
+        zf.comment = b'{"feet_format": "1", "feet_manifest": "feet/manifest.json"}'
+
+
+def test_sync(app):
+    (app / 'main.py').write_text('')
+    feet_py = open(FEET_PY).read()
+    make_exe(app / 'feet.exe', {
+        'feet/feet.py': feet_py,
+        'feet/cpython/lib.txt': 'v1',
+        'feet/cpython/old.txt': 'old',
+    })
+    with zipfile.ZipFile(str(app / 'feet.exe')) as zf:
+        for name in zf.namelist():
+            zf.extract(name, str(app / 'build'))
+    shutil.copytree(str(app / 'build' / 'feet'), str(app / 'feet_data'), dirs_exist_ok=True)
+
+    assert feet(app, 'verify').returncode == 0
+
+    make_exe(app / 'feet.exe', {
+        'feet/feet.py': feet_py,
+        'feet/cpython/lib.txt': 'v2',
+        'feet/cpython/new.txt': 'new',
+    })
+    p = feet(app, 'verify')
+    assert p.returncode == 1
+    assert p.stdout.splitlines()[:-1] == [
+        'Differs: ' + str(app / 'feet_data' / 'cpython' / 'lib.txt'),
+        'Differs: ' + str(app / 'feet_data' / 'cpython' / 'new.txt'),
+    ]
+
+    feet_mtime = os.stat(str(app / 'feet_data' / 'feet.py')).st_mtime_ns
+    p = feet(app, 'sync')
+    assert p.returncode == 0, p.stderr
+    assert 'Updated 2 files' in p.stdout
+
+    data = app / 'feet_data'
+    assert (data / 'cpython' / 'lib.txt').read_text() == 'v2'
+    assert (data / 'cpython' / 'new.txt').read_text() == 'new'
+    assert not (data / 'cpython' / 'old.txt').exists()
+    assert os.stat(str(data / 'feet.py')).st_mtime_ns == feet_mtime
+    assert (data / 'cpython' / 'python.exe').exists()
+    assert os.stat(str(data)).st_mtime >= os.stat(str(app / 'feet.exe')).st_mtime
+    assert feet(app, 'verify').returncode == 0
+
+
+def test_shared_runtime(app):
+    (app / 'main.py').write_text('import sys; print(sys.path[1])')
+    store = app / 'store' / 'abc123'
+    store.mkdir(parents=True)
+    os.symlink(sys.executable, str(store / 'python.exe'))
+    data = app / 'feet_data'
+    (data / 'runtime.txt').write_text(str(store) + '\n')
+    make_exe(app / 'feet.exe', {
+        'feet/feet.py': open(FEET_PY).read(),
+        'feet/cpython/lib.txt': 'v1',
+    })
+
+    # The runtime in the store is left alone and the private copy removed
+    p = feet(app, 'sync')
+    assert p.returncode == 0, p.stderr
+    assert not (data / 'cpython').exists()
+    assert not (store / 'lib.txt').exists()
+
+    p = subprocess.run(
+        [str(store / 'python.exe'), str(data / 'feet.py'), 'run'],
+        cwd=str(app), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+    assert p.returncode == 0, p.stderr
+    assert p.stdout.strip() == str(data / 'site-packages')
+
+
+def test_shared_runtime_switch(app):
+    (app / 'main.py').write_text('print("ran")')
+    (app / 'requirements.txt').write_text('feet-no-such-package==1.0\n')
+    data = app / 'feet_data'
+    (data / 'cpython' / 'lib' / 'site-packages').mkdir(parents=True)
+    (data / 'requirements_state.txt').write_text('digest 0 0\n')
+    (data / 'requirements_installed.txt').write_text('')
+    store = app / 'store' / 'abc123'
+    store.mkdir(parents=True)
+    os.symlink(sys.executable, str(store / 'python.exe'))
+    (data / 'runtime.txt').write_text(str(store) + '\n')
+    make_exe(app / 'feet.exe', {
+        'feet/feet.py': open(FEET_PY).read(),
+        'feet/cpython/lib.txt': 'v1',
+    })
+
+    # The libraries were in the private runtime, so they count as missing
+    p = feet(app, 'sync')
+    assert p.returncode == 0, p.stderr
+    assert not (data / 'cpython').exists()
+    assert not (data / 'requirements_state.txt').exists()
+    assert not (data / 'requirements_installed.txt').exists()
+
+    p = subprocess.run(
+        [str(store / 'python.exe'), str(data / 'feet.py'), 'run'],
+        cwd=str(app), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+        env=dict(os.environ, PIP_NO_INDEX='1'),
+    )
+    assert p.returncode == 0, p.stderr
+    assert 'Warning: installing libraries failed' in p.stderr
+
+
+MAIN_ZIPIMPORT = '''
+import os, sys
+import purepkg
+import nativepkg
+import datapkg
+print(purepkg.__file__)
+print(nativepkg._bisect.__file__)
+print(nativepkg.bisect([1, 2, 3], 2))
+print(datapkg.data)
+print(open('level.txt').read())
+print(os.getcwd())
+sys.exit(3)
+'''
+
+
+@pytest.mark.parametrize('compile', [None, 'alongside', 'replace'])
+def test_run_zipimport(app, tmp_path, compile):
+    import _bisect
+
+    (app / 'main.py').write_text(MAIN_ZIPIMPORT)
+    (app / 'level.txt').write_text('level 1')
+    lib = app / 'feet_data' / 'cpython' / 'lib' / 'site-packages'
+    (lib / 'purepkg').mkdir(parents=True)
+    (lib / 'purepkg' / '__init__.py').write_text('')
+    (lib / 'nativepkg').mkdir()
+    (lib / 'nativepkg' / '__init__.py').write_text('from ._bisect import bisect_left as bisect')
+    shutil.copy(_bisect.__file__, str(lib / 'nativepkg'))
+    # Typing markers don't need the disk, data read beside __file__ does
+    (lib / 'purepkg' / 'py.typed').write_text('')
+    (lib / 'datapkg').mkdir()
+    (lib / 'datapkg' / '__init__.py').write_text(
+        'import os\nwith open(os.path.join(os.path.dirname(__file__), "cacert.pem")) as f:\n    data = f.read()\n')
+    (lib / 'datapkg' / 'cacert.pem').write_text('certificates')
+
+    flags = ['--compile', compile] if compile else []
+    p = feet(app, 'exe', 'app', '--confirm', '--zipimport', *flags)
+    assert p.returncode == 0, p.stderr
+    exe = app / 'dist' / 'app.exe'
+    with zipfile.ZipFile(str(exe)) as zf:
+        names = zf.namelist()
+        assert ('pyz/app/main.py' in names) == (compile != 'replace')
+        assert 'level.txt' in names
+        assert ('pyz/lib/purepkg/__init__.py' in names) == (compile != 'replace')
+        assert ('pyz/lib/purepkg/__init__.pyc' in names) == bool(compile)
+        assert {info.compress_type for info in zf.infolist()} == {zipfile.ZIP_DEFLATED}
+        marker = zf.read('feet/zipimport.json')
+
+        # Installed the way the bootloader would: the data dir, and beside the
+        # exe only the app files that aren't imported from it
+        user = tmp_path / 'user'
+        data = user / 'app_data'
+        (data / 'cpython').mkdir(parents=True)
+        for name in names:
+            if not name.startswith(('pyz/', 'feet/')):
+                zf.extract(name, str(user))
+    shutil.copy(str(exe), str(user))
+    shutil.copy(FEET_PY, str(data))
+    (data / 'zipimport.json').write_bytes(marker)
+    os.symlink(sys.executable, str(data / 'cpython' / 'python.exe'))
+
+    p = subprocess.run(
+        [str(data / 'cpython' / 'python.exe'), str(data / 'feet.py'), 'run'],
+        cwd=str(user), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+    assert p.returncode == 3, p.stderr
+    pure, native, result, datafile, level, cwd = p.stdout.splitlines()
+    # zipimport reports the pyc it loaded as the module's file
+    pure_name = '__init__.pyc' if compile else '__init__.py'
+    assert pure == os.path.join(str(user / 'app.exe'), 'pyz', 'lib', 'purepkg', pure_name)
+    assert native.startswith(str(data / 'lazy' / 'nativepkg' / 'nativepkg'))
+    assert result == '1'
+    assert datafile == 'certificates'
+    assert level == 'level 1'
+    assert cwd == str(user)
+    assert not (user / 'main.py').exists()
+
+
+def test_exe_zipimport_rejects_wheels(app):
+    (app / 'main.py').write_text('')
+
+    p = feet(app, 'exe', 'app', '--confirm', '--zipimport', '--wheels')
+
+    assert p.returncode == 1
+    assert '--zipimport already bundles' in p.stdout
+    assert not (app / 'dist' / 'app.exe').exists()
+
+
+MAIN_WATCHED = '''
+import atexit, sys
+preloaded = 'json' in sys.modules
+import helper
+atexit.register(print, 'atexit ran')
+with open('dist/log.txt', 'a') as f:
+    f.write(f"{helper.value} {preloaded}\\n")
+'''
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='runs forked children')
+def test_run_watch(app):
+    import signal
+    import time
+
+    (app / 'main.py').write_text(MAIN_WATCHED)
+    (app / 'helper.py').write_text('value = 1')
+    (app / 'dist').mkdir()
+    log = app / 'dist' / 'log.txt'
+    data = app / 'feet_data'
+    p = subprocess.Popen(
+        [str(data / 'cpython' / 'python.exe'), str(data / 'feet.py'), 'run', '--watch', '--preload', 'json'],
+        cwd=str(app), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+
+    def wait_for(lines):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if log.exists() and log.read_text().splitlines() == lines:
+                return True
+            time.sleep(0.05)
+        return False
+
+    try:
+        assert wait_for(['1 True'])
+        # Runs again on a change, but not for files bundles exclude
+        (app / 'helper.py').write_text('value = 22')
+        assert wait_for(['1 True', '22 True'])
+        (app / 'dist' / 'other.txt').write_text('')
+        time.sleep(1)
+        assert log.read_text().splitlines() == ['1 True', '22 True']
+    finally:
+        p.send_signal(signal.SIGINT)
+        out, err = p.communicate(timeout=10)
+    assert p.returncode == 0, err
+    assert out.count('Preloaded json') == 1
+    assert out.count('atexit ran') == 2
+    assert 'Restarting, helper.py changed' in out